@@ -9,6 +9,7 @@ from traitlets import Bool, CInt, CUnicode, List, Unicode
 import component.parameter as param
 import component.scripts as cs
 import modules.stackcomposed.stack_composed.stack_composed as stack
+from component.workers.closing import ClosingFilter
 
 
 class Model(model.Model):
@@ -20,8 +21,12 @@ class Model(model.Model):
     # Statistics - used for statistic tile
     selected_stat = Unicode().tag(sync=True)
     cores = CInt().tag(sync=True)
+    scheduler = Unicode("processes").tag(sync=True)
     chunks = CInt(200).tag(sync=True)
+    auto_chunks = Bool(True).tag(sync=True)
+    use_cache = Bool(False).tag(sync=True)
     prefix = CUnicode("New_stack").tag(sync=True)
+    from_raw = Bool(False).tag(sync=True)
 
     folders = List().tag(sync=True)
     recursive = Bool().tag(sync=True)
@@ -38,8 +43,16 @@ class Model(model.Model):
             bands=1,
             output=output_name,
             num_process=self.cores,
-            chunksize=self.chunks,
+            chunksize="auto" if self.auto_chunks else self.chunks,
             inputs=image_file,
+            streaming=True,
+            scheduler=self.scheduler,
+            cache_dir=(
+                str(Path(output_name).parent / ".stack_composed_cache")
+                if self.use_cache
+                else None
+            ),
+            chunk_filter=ClosingFilter() if self.from_raw else None,
         )
 
     def get_inputs(self):
@@ -49,19 +62,23 @@ class Model(model.Model):
         Params:
             folders (list): Will use the bind folders from the statistics_tile folder
                             selector widget.
+            from_raw (bool): Use the raw images, filtered on the fly, instead of
+                            the processed ones.
         """
         if not self.folders:
             raise Exception("You have not selected any folder to process.")
 
+        pattern = "SMCmap*.tif" if self.from_raw else "close*.tif"
+
         images = list(
             set(
                 [
                     str(image)
                     for folder in self.folders
                     for image in (
-                        Path(folder).rglob("close*.tif")
+                        Path(folder).rglob(pattern)
                         if self.recursive
-                        else Path(folder).glob("close*.tif")
+                        else Path(folder).glob(pattern)
                     )
                 ]
             )
@@ -1,91 +1,90 @@
-import ntpath
+import concurrent.futures
 import os
-import subprocess
+import threading
+from multiprocessing import get_context
 from pathlib import Path
-from time import sleep
 
 from osgeo import gdal
 
+from component.workers.closing import process_image
 
-def filter_closing(image, tmp_path):
-    tmp_image = os.path.join(tmp_path, "tmp_closing.tif")
-    process = subprocess.run(
-        [
-            "otbcli_GrayScaleMorphologicalOperation",
-            "-in",
-            image,
-            "-out",
-            tmp_image,
-            "-structype",
-            "ball",
-            "-xradius",
-            "1",
-            "-yradius",
-            "1",
-            "-filter",
-            "closing",
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-    )
-    return process, tmp_image
 
+def get_dimension(image):
+    raster = gdal.Open(image)
+    return [raster.RasterXSize, raster.RasterYSize]
 
-def gdal_calculation(image, tmp_image, out_path):
-    image_name = ntpath.basename(image)
-    closed_image = os.path.join(out_path, "close_" + image_name)
 
-    process = subprocess.run(
-        [
-            "gdal_calc.py",
-            "-A",
-            image,
-            "-B",
-            tmp_image,
-            "--NoDataValue=0",
-            "--co=COMPRESS=LZW",
-            "--type=UInt16",
-            "--overwrite",
-            "--outfile=" + closed_image,
-            "--calc=B*(A==0)+A",
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-    )
-    return process
+def batch_raw_to_processed(
+    shared_variable: threading.Event,
+    image_files,
+    alert,
+    images_span,
+    max_workers=None,
+):
+    """
+    Filter the images in a bounded pool of processes, one image per worker.
 
+    There are max_workers processes, all the cores by default. Only 2
+    images per worker are submitted at the same time, so the batch
+    stops soon after the shared_variable is set: the submitted images are
+    finished and the rest are not started. Each image is reported in the
+    alert and counted in the images_span when it is done.
 
-def remove_tmp_image(tmp_image):
-    os.remove(tmp_image)
-    return
+    Args:
+    ----
+        shared_variable (threading.Event): Shared variable to stop the batch
+        image_files (list): paths of the images in 0_raw to filter
+        alert (cw.Alert): alert to report the progress
+        images_span (CountSpan): span to count the images done
+        max_workers (int): number of processes
 
+    """
+    max_workers = max_workers or os.cpu_count()
+    images_span.set_total(len(image_files))
+    alert.children = [*alert.children, images_span]
 
-def get_dimension(image):
-    raster = gdal.Open(image)
-    return [raster.RasterXSize, raster.RasterYSize]
+    pending = iter(image_files)
+    running = {}
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers, mp_context=get_context("spawn")
+    ) as executor:
+        while True:
+            while not shared_variable.is_set() and len(running) < 2 * max_workers:
+                image = next(pending, None)
+                if image is None:
+                    break
+                running[executor.submit(process_image, image)] = image
+            if not running:
+                break
 
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                image_name = Path(running.pop(future)).name
+                try:
+                    processed = future.result()
+                except Exception as e:
+                    failed += 1
+                    alert.append_msg(f"Error: {image_name}: {e}", type_="error")
+                    continue
+                finally:
+                    images_span.update()
+                if processed:
+                    alert.append_msg(f"Processed: {image_name}")
+                else:
+                    alert.append_msg(
+                        f'Skipping: Image "{image_name}" already processed'
+                    )
 
-def raw_to_processed(image, alert):
-    image_name = Path(image).name
-    out_close_path = str(Path(image).parent).replace("0_raw", "1_processed")
-    Path(out_close_path).mkdir(parents=True, exist_ok=True)
-    out_image = Path(out_close_path, f"close_{image_name}")
+    if shared_variable.is_set():
+        return
 
-    if not out_image.exists():
-        alert.append_msg(f"Processing: {image_name}...")
-        filter_process, tmp_image = filter_closing(image, str(out_close_path))
-        if filter_process.returncode == 0:
-            gdal_process = gdal_calculation(image, tmp_image, str(out_close_path))
-            if gdal_process.returncode == 0:
-                remove_tmp_image(tmp_image)
-            else:
-                raise Exception(gdal_process.stderr)
-        else:
-            raise Exception(filter_process.stderr)
+    if failed:
+        alert.append_msg(
+            f"{failed} of {len(image_files)} images could not be processed.",
+            type_="warning",
+        )
     else:
-        alert.append_msg(f'Skipping: Image "{image_name}" already exists')
-
-    # this process is fast, so, let's wat some time after ach iteration
-    sleep(0.5)
+        alert.append_msg("All the images were correctly processed.", type_="success")
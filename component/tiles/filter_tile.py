@@ -1,13 +1,14 @@
 from pathlib import Path
 
 import ipyvuetify as v
-import sepal_ui.scripts.utils as su
 import sepal_ui.sepalwidgets as sw
 
 import component.parameter as param
 import component.scripts.filter_closing_smm as cls_filter
 import component.widget as cw
 from component.message import cm
+from component.scripts.taks_controller import TaskController
+from component.widget.count_span import CountSpan
 
 __all__ = ["FilterTile"]
 
@@ -35,14 +36,15 @@ class FilterTile(v.Layout, sw.SepalWidget):
 
 class FilterView(v.Card):
     def __init__(self, *args, **kwargs):
-        self.counter = 0
         self.min_height = "600px"
         self.class_ = "pa-2"
 
         super().__init__(*args, **kwargs)
 
         self.btn = sw.Btn("Apply morphological filter", class_="mb-2")
+        self.stop_btn = sw.Btn(text="Stop", class_="ml-2 mb-2", color="secondary")
         self.alert = cw.Alert()
+        self.images_span = CountSpan("Images")
 
         self.w_selector_view = cw.FolderSelectorView(
             folder=param.RAW_DIR, wildcard="[!.]*.tif"
@@ -62,7 +64,10 @@ class FilterView(v.Card):
                             v.Card(
                                 children=[
                                     v.CardTitle(children=["Process"]),
-                                    self.btn,
+                                    sw.Flex(
+                                        class_="d-flex",
+                                        children=[self.btn, self.stop_btn],
+                                    ),
                                     self.alert,
                                 ]
                             )
@@ -74,15 +79,24 @@ class FilterView(v.Card):
 
         self.btn.on_event("click", self.on_click)
 
-    @su.loading_button()
     def on_click(self, *args):
-        """Run filter script."""
+        """Run filter script in a separated thread, so it can be stopped."""
+        self.images_span.reset()
+
+        task_controller = TaskController(
+            self.btn,
+            self.stop_btn,
+            self.alert,
+            self.run_filter,
+        )
+
+        task_controller.start_task()
+
+    def run_filter(self, shared_variable):
+        """Filter all the images of the selected folders in parallel."""
         process_path = self.w_selector.v_model
         recursive = self.w_selector_view.w_recursive.v_model
 
-        # reinitialize the counter
-        self.counter = 0
-
         if not process_path:
             raise Exception("Please select a folder containing .tif images.")
 
@@ -112,11 +126,6 @@ class FilterView(v.Card):
                 f"The image dimension is {dimension[0]} x {dimension[1]} px"
             )
 
-        for image in image_files:
-            cls_filter.raw_to_processed(image, self.alert)
-            self.counter += 1
-            # self.alert.update_progress(self.counter, total=len(image_files))
-
-        self.alert.append_msg(
-            "All the images were correctly processed.", type_="success"
+        cls_filter.batch_raw_to_processed(
+            shared_variable, image_files, self.alert, self.images_span
         )
@@ -56,12 +56,20 @@ class StatsInputView(sw.Layout):
         self.model = model
 
         self.w_selector_view = cw.FolderSelectorView(
-            folder=param.PROCESSED_DIR.parent, wildcard="close*.tif"
+            folder=param.PROCESSED_DIR.parent,
+            wildcard="SMCmap*.tif" if self.model.from_raw else "close*.tif",
         )
         self.w_selector = self.w_selector_view.w_selector
         self.btn = sw.Btn("View images", class_="mb-2", small=True)
         self.alert = sw.Alert()
 
+        self.w_from_raw = v.Switch(
+            label="Use raw images (filter on the fly)",
+            v_model=self.model.from_raw,
+            small=True,
+            class_="mt-0",
+        )
+
         self.date_selector = cw.DateSelector(season=True, remove_method=["single"])
         self.date_selector.date_method = "all"
 
@@ -101,6 +109,7 @@ class StatsInputView(sw.Layout):
                             v.Card(
                                 children=[
                                     v.CardTitle(children=["Date selection"]),
+                                    self.w_from_raw,
                                     self.date_selector,
                                     self.btn,
                                     self.w_summary,
@@ -115,7 +124,7 @@ class StatsInputView(sw.Layout):
 
         self.model.bind(self.w_selector_view.w_recursive, "recursive").bind(
             self.w_selector, "folders"
-        )
+        ).bind(self.w_from_raw, "from_raw")
 
         dlink((self.date_selector, "date_method"), (self.model, "date_method"))
         dlink((self.date_selector, "start_date"), (self.model, "start_date"))
@@ -124,6 +133,7 @@ class StatsInputView(sw.Layout):
         dlink((self.date_selector, "selected_months"), (self.model, "selected_months"))
 
         self.w_selector.observe(self.fill_season, "v_model")
+        self.model.observe(self.set_wildcard, "from_raw")
         self.w_selector.v_model
 
         self.btn.on_event("click", self.get_list_of_images)
@@ -131,6 +141,11 @@ class StatsInputView(sw.Layout):
             "click", lambda *args: setattr(self.w_summary, "v_model", False)
         )
 
+    def set_wildcard(self, change):
+        """Count the raw or the filtered images in the selected folders, as get_inputs."""
+        self.w_selector_view.wildcard = "SMCmap*.tif" if change["new"] else "close*.tif"
+        self.w_selector_view.get_image_number({"new": self.w_selector.v_model})
+
     @su.loading_button()
     def get_list_of_images(self, *args):
         """Display the list of images filtered by the date selector on a dialog."""
@@ -243,6 +258,22 @@ class StatisticsView(v.Layout):
             max=cpu_count(),
         )
 
+        self.w_scheduler = v.Select(
+            label="Scheduler",
+            items=[
+                {"text": "Processes", "value": "processes"},
+                {"text": "Threads", "value": "threads"},
+                {"text": "Hybrid (processes reading with threads)", "value": "hybrid"},
+            ],
+            v_model=self.model.scheduler,
+        )
+
+        self.w_auto_chunk = v.Switch(
+            label="Automatic chunk size",
+            v_model=self.model.auto_chunks,
+            class_="mb-2 mt-0 mr-2",
+        )
+
         self.w_chunk = v.Slider(
             v_model=200,
             thumb_label="Always",
@@ -250,6 +281,22 @@ class StatisticsView(v.Layout):
             label="Chunk size",
             max=1000,
             min=20,
+            disabled=self.model.auto_chunks,
+        )
+
+        self.w_auto_chunk.observe(
+            lambda chg: setattr(self.w_chunk, "disabled", chg["new"]), "v_model"
+        )
+
+        w_chunk = v.Flex(
+            class_="d-flex",
+            children=[self.w_auto_chunk, self.w_chunk],
+        )
+
+        self.w_cache = v.Switch(
+            label="Cache the chunks for the next runs (up to 10 GB)",
+            v_model=self.model.use_cache,
+            class_="mt-0",
         )
 
         advanced_settings = v.ExpansionPanels(
@@ -259,7 +306,14 @@ class StatisticsView(v.Layout):
                 v.ExpansionPanel(
                     children=[
                         v.ExpansionPanelHeader(children=["Advanced settings"]),
-                        v.ExpansionPanelContent(children=[self.w_cores, self.w_chunk]),
+                        v.ExpansionPanelContent(
+                            children=[
+                                self.w_cores,
+                                self.w_scheduler,
+                                w_chunk,
+                                self.w_cache,
+                            ]
+                        ),
                     ],
                 ),
             ],
@@ -277,6 +331,9 @@ class StatisticsView(v.Layout):
         self.model.bind(self.w_stats, "items").bind(self.w_stats, "selected_stat").bind(
             self.w_cores, "cores"
         ).bind(self.w_chunk, "chunks").bind(self.w_prefix, "prefix")
+        self.model.bind(self.w_scheduler, "scheduler").bind(
+            self.w_auto_chunk, "auto_chunks"
+        ).bind(self.w_cache, "use_cache")
 
         self.btn.on_event("click", self.on_click)
 
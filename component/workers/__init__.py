@@ -0,0 +1,4 @@
+# the modules of this package run in the spawned worker processes (filter and
+# stack_composed workers), they only import numpy, scipy and GDAL and nothing
+# is imported here, so the workers don't load sepal_ui, ee or pandas as the
+# component.scripts package does
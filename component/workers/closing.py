@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal
+from scipy import ndimage
+
+# ball structuring element of radius 1 as in otbcli_GrayScaleMorphologicalOperation
+# (-structype ball -xradius 1 -yradius 1), the full 3x3 neighbourhood
+STRUCTURE_SIZE = (3, 3)
+# the closing is a dilation followed by an erosion, a pixel depends on the
+# pixels up to 2 times the radius of the structuring element
+HALO = 2
+# size of the output tiles and of the windows filtered at once (a multiple
+# of the tiles), the memory doesn't depend on the size of the raster
+BLOCK_SIZE = 256
+WINDOW_SIZE = 2048
+
+
+def filter_closing(array):
+    """
+    Grey closing of the array with the 0 pixels filled, as B*(A==0)+A.
+
+    The pixels outside the image are ignored as in OTB, the pixels with 0
+    take the value of the closing and the rest keep their value.
+    """
+    closed = ndimage.grey_closing(array, size=STRUCTURE_SIZE, mode="nearest")
+    return np.where(array == 0, closed, array).astype(np.uint16)
+
+
+def filter_closing_window(band, xoff, yoff, xsize, ysize):
+    """
+    Filter the window of the band reading it with a halo of HALO pixels.
+
+    The halo is cut at the edges of the raster, where the pixels outside the
+    image are ignored as in filter_closing, so the window is equal to the
+    same window of the whole raster filtered at once.
+    """
+    x_min = max(xoff - HALO, 0)
+    y_min = max(yoff - HALO, 0)
+    x_max = min(xoff + xsize + HALO, band.XSize)
+    y_max = min(yoff + ysize + HALO, band.YSize)
+
+    array = band.ReadAsArray(x_min, y_min, x_max - x_min, y_max - y_min)
+    closed = filter_closing(array)
+    # the window without the halo
+    y_start = yoff - y_min
+    x_start = xoff - x_min
+    return closed[y_start : y_start + ysize, x_start : x_start + xsize]
+
+
+class ClosingFilter:
+    """
+    Closing filter applied by stack_composed to the chunks of the raw images.
+
+    The statistics are computed from the raw images as from their close_*.tif
+    outputs, without writing them (see stack_composed Image.read_filtered).
+    """
+
+    halo = HALO
+    nodata = 0
+
+    def __call__(self, array):
+        """Filter the array of a band read with a halo of HALO pixels."""
+        return filter_closing(array)
+
+    def __repr__(self):
+        """Describe the filter, it is part of the keys of the chunks cache."""
+        return f"ClosingFilter(size={STRUCTURE_SIZE}, halo={HALO})"
+
+
+def write_closing(image, closed_image):
+    """
+    Write the closing filter of the image in closed_image.
+
+    The output is a tiled and compressed UInt16 GeoTIFF with 0 as nodata,
+    the image is filtered by windows of WINDOW_SIZE so the memory doesn't
+    depend on the size of the image.
+    """
+    raster = gdal.Open(image)
+    band = raster.GetRasterBand(1)
+
+    driver = gdal.GetDriverByName("GTiff")
+    out_raster = driver.Create(
+        str(closed_image),
+        raster.RasterXSize,
+        raster.RasterYSize,
+        1,
+        gdal.GDT_UInt16,
+        [
+            "COMPRESS=LZW",
+            "TILED=YES",
+            f"BLOCKXSIZE={BLOCK_SIZE}",
+            f"BLOCKYSIZE={BLOCK_SIZE}",
+            "BIGTIFF=IF_SAFER",
+        ],
+    )
+    out_raster.SetGeoTransform(raster.GetGeoTransform())
+    out_raster.SetProjection(raster.GetProjection())
+    out_band = out_raster.GetRasterBand(1)
+    out_band.SetNoDataValue(0)
+    for yoff in range(0, raster.RasterYSize, WINDOW_SIZE):
+        ysize = min(WINDOW_SIZE, raster.RasterYSize - yoff)
+        for xoff in range(0, raster.RasterXSize, WINDOW_SIZE):
+            xsize = min(WINDOW_SIZE, raster.RasterXSize - xoff)
+            out_band.WriteArray(
+                filter_closing_window(band, xoff, yoff, xsize, ysize), xoff, yoff
+            )
+    out_band.FlushCache()
+
+    del band, raster, out_band, out_raster
+
+
+def get_out_image(image):
+    image_name = Path(image).name
+    out_close_path = str(Path(image).parent).replace("0_raw", "1_processed")
+    Path(out_close_path).mkdir(parents=True, exist_ok=True)
+    return Path(out_close_path, f"close_{image_name}")
+
+
+def get_manifest_path(out_image):
+    return Path(out_image.parent, f"{out_image.name}.manifest.json")
+
+
+def get_file_hash(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def write_manifest(manifest_path, manifest):
+    tmp_path = Path(manifest_path.parent, f".{manifest_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_processed(image, out_image):
+    """
+    Return True if the output of the image is complete and up to date.
+
+    The manifest next to the output records the size, modification time and
+    hash of the source image, the size of the output and the filter. Only
+    the manifest and the file stats are read, the source is hashed only if
+    its modification time changed but not its size, then the new time is
+    recorded if the content is the same.
+    """
+    manifest_path = get_manifest_path(out_image)
+    if not (manifest_path.exists() and out_image.exists()):
+        return False
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    source = os.stat(image)
+    if (
+        manifest["filter"] != repr(ClosingFilter())
+        or manifest["output_size"] != out_image.stat().st_size
+        or manifest["source_size"] != source.st_size
+    ):
+        return False
+    if manifest["source_mtime_ns"] == source.st_mtime_ns:
+        return True
+
+    if manifest["source_hash"] != get_file_hash(image):
+        return False
+    manifest["source_mtime_ns"] = source.st_mtime_ns
+    write_manifest(manifest_path, manifest)
+    return True
+
+
+def process_image(image):
+    """
+    Filter the image if its output is not up to date, it runs in the batch workers.
+
+    The output is written in a hidden temporal file renamed at the end, and
+    then its manifest, so a partial output of an interrupted run is never
+    taken as processed. Return True if it was processed and False if it was
+    skipped.
+    """
+    out_image = get_out_image(image)
+    if is_processed(image, out_image):
+        return False
+
+    source = os.stat(image)
+    tmp_image = Path(out_image.parent, f".{out_image.name}.{os.getpid()}.tmp")
+    try:
+        write_closing(image, tmp_image)
+        os.replace(tmp_image, out_image)
+    finally:
+        if tmp_image.exists():
+            tmp_image.unlink()
+
+    write_manifest(
+        get_manifest_path(out_image),
+        {
+            "source_size": source.st_size,
+            "source_mtime_ns": source.st_mtime_ns,
+            "source_hash": get_file_hash(image),
+            "output_size": out_image.stat().st_size,
+            "filter": repr(ClosingFilter()),
+        },
+    )
+    return True
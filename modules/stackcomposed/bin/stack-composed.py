@@ -42,6 +42,15 @@ def script():
             msg = "not a valid date: '{0}'".format(s)
             raise argparse.ArgumentTypeError(msg)
 
+    def chunks_validator(s):
+        if s == "auto":
+            return s
+        try:
+            return int(s)
+        except ValueError:
+            msg = "not a valid chunks size: '{0}'".format(s)
+            raise argparse.ArgumentTypeError(msg)
+
     def nodata_validator(s):
         try:
             return float(s)
@@ -67,7 +76,11 @@ def script():
                 raise argparse.ArgumentTypeError(msg)
 
     parser.add_argument(
-        "-stat", type=str, help="Statistic for compute the composed", required=True
+        "-stat",
+        type=str,
+        help="Statistic or statistics comma separated for compute the composed,\n"
+        "e.g. mean,std,median",
+        required=True,
     )
     parser.add_argument(
         "-bands", type=str, help="Band or bands to process, e.g. 1,2,3", required=True
@@ -101,10 +114,94 @@ def script():
         required=False,
     )
     parser.add_argument(
-        "-chunks",
+        "-scheduler",
+        "--scheduler",
+        type=str,
+        dest="scheduler",
+        default="processes",
+        help="Scheduler for the parallel process: processes, threads (GDAL and\n"
+        "numpy release the GIL) or hybrid (processes that read the images\n"
+        "with threads)",
+        required=False,
+        choices=("processes", "threads", "hybrid"),
+    )
+    parser.add_argument(
+        "-cache_dir",
+        "--cache_dir",
+        type=str,
+        dest="cache_dir",
+        default=None,
+        help="Directory to save the result of each chunk and reuse it in the\n"
+        "next runs, only the chunks with new or changed images are computed",
+        required=False,
+    )
+    parser.add_argument(
+        "-cache_max_size",
+        "--cache_max_size",
+        type=float,
+        dest="cache_max_size",
+        default=10,
+        help="Maximum size of the cache in GB, the least recently used chunks\n"
+        "above it are deleted after each run (default: 10)",
+        required=False,
+    )
+    parser.add_argument(
+        "-state_dir",
+        "--state_dir",
+        type=str,
+        dest="state_dir",
+        default=None,
+        help="Directory of the incremental state (count, sum, sum of squares,\n"
+        "min, max and last pixel), only the new images are read to update it\n"
+        "(mean, std, valid_pixels, min, max, last_pixel, jday_last_pixel)",
+        required=False,
+    )
+    parser.add_argument(
+        "-vrt",
+        "--vrt",
+        action="store_true",
+        dest="vrt",
+        help="Read the images through in-memory VRTs in the wrapper grid,\n"
+        "resampling (nearest) the images with different pixel size",
+        required=False,
+    )
+    parser.add_argument(
+        "-group_dates",
+        "--group_dates",
+        action="store_true",
+        dest="group_dates",
+        help="Mosaic the images of the same date (e.g. chips) in one layer\n"
+        "of the time series, the date is parsed from the filename",
+        required=False,
+    )
+    parser.add_argument(
+        "-quantile_bins",
+        "--quantile_bins",
         type=int,
+        dest="quantile_bins",
+        default=None,
+        help="Approximate the median and percentiles with a histogram of this\n"
+        "number of bins for each pixel, without the stack of all images",
+        required=False,
+    )
+    parser.add_argument(
+        "-quantile_range",
+        "--quantile_range",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        dest="quantile_range",
+        default=None,
+        help="Range of the values for the histogram of -quantile_bins,\n"
+        "by default the exact range of the values of the images",
+        required=False,
+    )
+    parser.add_argument(
+        "-chunks",
+        type=chunks_validator,
         default=1000,
-        help="Chunks size for parallel process",
+        help="Chunks size for parallel process, or 'auto' for choose it\n"
+        "based on the available memory",
         required=False,
     )
     parser.add_argument(
@@ -121,6 +218,24 @@ def script():
         help="End date for filter data, format YYYY-MM-DD",
         required=False,
     )
+    parser.add_argument(
+        "-streaming",
+        "--streaming",
+        action="store_true",
+        dest="streaming",
+        help="Write each chunk directly in a tiled output instead of\n"
+        "keeping the whole result in memory",
+        required=False,
+    )
+    parser.add_argument(
+        "-multiband",
+        "--multiband",
+        action="store_true",
+        dest="multiband",
+        help="Save all statistics as bands of one file instead of one file\n"
+        "for each statistic",
+        required=False,
+    )
     parser.add_argument(
         "inputs", type=str, help="Directories or images files to process", nargs="*"
     )
@@ -130,14 +245,24 @@ def script():
     stack_composed.run(
         args.stat,
         args.bands,
-        args.nodata,
         args.output,
-        args.output_type,
-        args.p,
-        args.chunks,
-        args.start_date,
-        args.end_date,
         args.inputs,
+        nodata=args.nodata,
+        output_type=args.output_type,
+        num_process=args.p,
+        chunksize=args.chunks,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        streaming=args.streaming,
+        multiband=args.multiband,
+        scheduler=args.scheduler,
+        cache_dir=args.cache_dir,
+        cache_max_size=int(args.cache_max_size * 1024**3),
+        state_dir=args.state_dir,
+        quantile_bins=args.quantile_bins,
+        quantile_range=args.quantile_range,
+        vrt=args.vrt,
+        group_dates=args.group_dates,
     )
 
 
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2016-2018 Xavier Corredor Llano, SMBYC
+#  Email: xcorredorl at ideam.gov.co
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from .image import Image
+
+# change it when the result of the chunks computed changes, invalidating
+# all the chunks saved in the cache
+CACHE_VERSION = 1
+# default maximum size of the cache in bytes, the least recently used
+# chunks above it are deleted after each run
+MAX_CACHE_SIZE = 10 * 1024**3
+# chunks size of the automatic chunks used with the cache
+CHUNKSIZE_FILE = "chunksize.json"
+
+
+def image_fingerprint(image):
+    """
+    Return the path, modification time and size of the image file.
+    """
+    file_stat = os.stat(image.file_path)
+    return [os.path.abspath(image.file_path), file_stat.st_mtime_ns, file_stat.st_size]
+
+
+def chunk_key(stats, bands, window, fingerprints, options=None):
+    """
+    Return the key in the cache of the result of a chunk, a hash of the
+    statistics, bands, window of the chunk in the wrapper (yc, xc, ysize,
+    xsize), the fingerprints of the images that overlap the chunk, the no
+    data values, the chunk filter and the VRT reading, together with the
+    wrapper properties and other options that change the result.
+    """
+    content = [
+        CACHE_VERSION,
+        list(stats),
+        list(bands),
+        [int(i) for i in window],
+        Image.wrapper_extent,
+        Image.wrapper_x_res,
+        Image.wrapper_y_res,
+        Image.nodata_from_arg,
+        repr(Image.chunk_filter),
+        Image.vrt,
+        fingerprints,
+        options,
+    ]
+    return hashlib.sha256(json.dumps(content, default=str).encode()).hexdigest()
+
+
+def chunk_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ".npy")
+
+
+def load_chunk(cache_dir, key):
+    """
+    Return the result of the chunk saved in the cache, None if it is not.
+    """
+    path = chunk_path(cache_dir, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        chunk_array = np.load(path)
+    except (OSError, ValueError):
+        # incomplete or corrupted file, compute it again
+        return None
+    # mark it as recently used for prune_cache
+    os.utime(path)
+    return chunk_array
+
+
+def save_chunk(cache_dir, key, chunk_array):
+    """
+    Save the result of the chunk in the cache. It is written in a temporal
+    file renamed at the end, so a chunk in the cache is always complete.
+    """
+    tmp_path = os.path.join(
+        cache_dir, ".{}.{}.{}.tmp".format(key, os.getpid(), threading.get_ident())
+    )
+    with open(tmp_path, "wb") as tmp_file:
+        np.save(tmp_file, chunk_array)
+    os.replace(tmp_path, chunk_path(cache_dir, key))
+
+
+def prune_cache(cache_dir, max_size=MAX_CACHE_SIZE):
+    """
+    Delete the least recently used (saved or loaded) chunks of the cache
+    until its size is not larger than max_size bytes. Return the number of
+    chunks deleted.
+    """
+    chunks = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy") and entry.is_file():
+            entry_stat = entry.stat()
+            chunks.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry.path))
+    cache_size = sum(size for _, size, _ in chunks)
+
+    deleted = 0
+    for _, size, path in sorted(chunks):
+        if cache_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        cache_size -= size
+        deleted += 1
+    return deleted
+
+
+def cache_chunksize(cache_dir, chunksize):
+    """
+    Return the automatic chunks size used by the previous runs with the
+    cache if it is not larger than chunksize, planned for the memory
+    available now, else save and return chunksize rounded down to a power
+    of 2. The chunks grid, and so the keys of the chunks, don't change with
+    the free memory between runs unless it is about 4 times smaller.
+    """
+    chunksize = 2 ** int(np.log2(chunksize))
+    path = os.path.join(cache_dir, CHUNKSIZE_FILE)
+    try:
+        with open(path, "r") as chunksize_file:
+            cached_chunksize = json.load(chunksize_file)["chunksize"]
+        if cached_chunksize <= chunksize:
+            return cached_chunksize
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, ".{}.{}.tmp".format(CHUNKSIZE_FILE, os.getpid()))
+    with open(tmp_path, "w") as chunksize_file:
+        json.dump({"chunksize": chunksize}, chunksize_file)
+    os.replace(tmp_path, path)
+    return chunksize
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2016-2018 Xavier Corredor Llano, SMBYC
+#  Email: xcorredorl at ideam.gov.co
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+import os
+
+import numpy as np
+
+from .image import Image
+from .stats import is_masked_stat
+
+# fraction of the available memory for the chunks in process, the rest is
+# for GDAL block cache, dask and the other programs
+MEMORY_FRACTION = 0.5
+# limits of the side of the chunks, below the minimum the overhead of each
+# chunk (scheduling, open and read) dominates
+MIN_CHUNKSIZE = 128
+MAX_CHUNKSIZE = 4096
+# sizes of the tiles of the streaming output (multiples of 16 for GTiff)
+OUTPUT_BLOCK_SIZES = (512, 256, 128, 64, 32, 16)
+# peak memory of the temporaries of each statistic, in copies of the float32
+# stack of one band (measured with tracemalloc), the statistics are computed
+# one by one for each band; with integer images the median and percentiles
+# use the masked path
+STAT_STACK_COPIES = {
+    "median": 6,
+    "mean": 2,
+    "gmean": 5,
+    "max": 0.5,
+    "min": 0.5,
+    "std": 2,
+    "valid_pixels": 0.5,
+    "last_pixel": 1.5,
+    "jday_last_pixel": 1.5,
+    "jday_median": 5,
+    "linear_trend": 0.5,
+    "percentile": 1.5,
+    "trim_mean": 4,
+    "sum": 1.5,
+    "sum_squares": 5,
+    "last_day": 1.5,
+}
+MASKED_STAT_STACK_COPIES = {
+    "median": 1,
+    "max": 0.5,
+    "min": 0.5,
+    "valid_pixels": 0.5,
+    "percentile": 1,
+}
+
+
+def available_memory():
+    """
+    Return the memory available for new processes in bytes, without swap.
+    In a container it is not more than the free memory of its cgroup limit.
+    """
+    memory = None
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    if memory is None:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+    # cgroup v2 limit, "max" if there is no limit
+    try:
+        with open("/sys/fs/cgroup/memory.max", "r") as memory_max:
+            limit = memory_max.read().strip()
+        with open("/sys/fs/cgroup/memory.current", "r") as memory_current:
+            current = int(memory_current.read().strip())
+        if limit != "max":
+            memory = min(memory, max(int(limit) - current, 0))
+    except (OSError, ValueError):
+        pass
+    return memory
+
+
+def stat_stack_copies(stat, masked=False):
+    """
+    Return the peak memory of the temporaries of the statistic in copies of
+    the float32 stack of one band, see STAT_STACK_COPIES.
+    """
+    for prefix in ("percentile", "trim_mean"):
+        if stat.startswith(prefix + "_"):
+            stat = prefix
+    copies = MASKED_STAT_STACK_COPIES if masked else STAT_STACK_COPIES
+    return copies.get(stat, 2)
+
+
+def bytes_per_pixel(n_images, n_bands, stats, quantile_bins=None, integer_type=None):
+    """
+    Estimate the memory used by each pixel of a chunk in process: the
+    stack of the images (float32, or integer_type and its validity mask in
+    the masked path), the temporaries of the most expensive statistic and
+    the results (float64). With quantile_bins it is the histogram and its
+    cumulative instead of the stack.
+    """
+    results = 2 * n_bands * len(stats) * 8
+    if quantile_bins is not None:
+        counter_size = np.min_scalar_type(n_images).itemsize
+        stack = n_bands * quantile_bins * counter_size + quantile_bins * (4 + 1)
+        return stack + results
+
+    masked = integer_type is not None
+    if masked:
+        layer_size = np.dtype(integer_type).itemsize + 1
+    else:
+        layer_size = 4
+    temporaries = max(stat_stack_copies(stat, masked) for stat in stats)
+    stack = n_bands * n_images * layer_size + temporaries * n_images * 4
+    return int(np.ceil(stack + results))
+
+
+def common_block_size(images):
+    """
+    Return the block size (x, y) of the first band if it is the same for all
+    images, else None.
+    """
+    block_sizes = set(tuple(image.block_size) for image in images)
+    if len(block_sizes) == 1:
+        return block_sizes.pop()
+    return None
+
+
+def plan_chunksize(
+    images, n_bands, stats, num_process, quantile_bins=None, n_layers=None
+):
+    """
+    Choose the size of the square chunks: the largest chunks that fit in
+    the available memory for all workers at the same time, not larger than
+    needed for keep all workers busy, and aligned to the tiles of the
+    images. The depth of the stack is n_layers if the images are grouped
+    by date, else the number of images. The memory of each pixel depends
+    on the statistics computed. Print the plan and return the chunks size.
+    """
+    num_process = num_process or os.cpu_count()
+    memory = available_memory()
+    n_layers = n_layers or len(images)
+    # the masked path of the statistics (see stats.statistic)
+    integer_type = None
+    if all(is_masked_stat(stat) for stat in stats) and all(
+        image.integer_type is not None for image in images
+    ):
+        integer_type = np.result_type(*[image.integer_type for image in images])
+    pixel_bytes = bytes_per_pixel(n_layers, n_bands, stats, quantile_bins, integer_type)
+
+    # largest square chunks that fit in memory for all workers
+    chunksize = int(np.sqrt(memory * MEMORY_FRACTION / num_process / pixel_bytes))
+    # at least one chunk for each worker
+    wrapper_y, wrapper_x = Image.wrapper_shape
+    chunksize = min(
+        chunksize, int(np.ceil(np.sqrt(wrapper_y * wrapper_x / num_process)))
+    )
+    chunksize = max(min(chunksize, MAX_CHUNKSIZE), MIN_CHUNKSIZE)
+
+    # aligned to the tiles of the images, read each tile by only one chunk
+    block_size = common_block_size(images)
+    aligned = (
+        block_size is not None
+        and block_size[0] == block_size[1] > 1
+        and chunksize >= block_size[0]
+    )
+    if aligned:
+        chunksize = chunksize // block_size[0] * block_size[0]
+
+    print(
+        "  chunks size (auto): {0} x {0} pixels, ~{1:.0f} MB per chunk for {2} layers, "
+        "{3} workers, {4:.0f} MB available{5}".format(
+            chunksize,
+            chunksize**2 * pixel_bytes / 1024**2,
+            n_layers,
+            num_process,
+            memory / 1024**2,
+            ", aligned to tiles of {}x{}".format(*block_size) if aligned else "",
+        )
+    )
+    return chunksize
+
+
+def most_common(values):
+    values, counts = np.unique(values, return_counts=True)
+    return int(values[np.argmax(counts)])
+
+
+def axis_chunks(length, chunk, phase):
+    """
+    Return the chunks sizes along an axis of the wrapper with the limits in
+    phase + k * chunk.
+    """
+    limits = [0] + list(range(phase or chunk, length, chunk)) + [length]
+    return tuple(int(end - start) for start, end in zip(limits[:-1], limits[1:]))
+
+
+def decoded_blocks(images, y_chunks, x_chunks):
+    """
+    Return the number of blocks of the images read (decoded) by the chunks
+    grid, a block read by several chunks is counted for each one.
+    """
+    y_limits = np.cumsum((0,) + tuple(y_chunks))
+    x_limits = np.cumsum((0,) + tuple(x_chunks))
+    n_blocks = 0
+    for image in images:
+        block_x, block_y = image.block_size
+        n_blocks_by_axis = []
+        for limits, i_min, i_max, block in (
+            (y_limits, image.yi_min, image.yi_max, block_y),
+            (x_limits, image.xi_min, image.xi_max, block_x),
+        ):
+            # window of each chunk in the image and the blocks in it
+            start = np.clip(limits[:-1], i_min, i_max) - i_min
+            end = np.clip(limits[1:], i_min, i_max) - i_min
+            in_image = end > start
+            n_blocks_by_axis.append(
+                ((end[in_image] - 1) // block - start[in_image] // block + 1).sum()
+            )
+        n_blocks += n_blocks_by_axis[0] * n_blocks_by_axis[1]
+    return int(n_blocks)
+
+
+def plan_chunks(images, chunksize):
+    """
+    Return the chunks grid of the wrapper ((y chunks), (x chunks)) for the
+    chunks size, with the limits of the chunks on the limits of the blocks
+    of the images, so each compressed block is decoded by one chunk:
+
+    - strips (blocks of the full width of the images): chunks of full
+      width rows with about the same pixels of the chunksize square chunks
+    - tiles of the same size in all images: chunks of a multiple of the
+      tiles, aligned to the tiles grid of most of the images
+
+    If the images don't have a common layout the square chunks are
+    returned. Print the number of blocks decoded with and without align.
+    """
+    wrapper_y, wrapper_x = Image.wrapper_shape
+    square_chunks = (
+        axis_chunks(wrapper_y, chunksize, 0),
+        axis_chunks(wrapper_x, chunksize, 0),
+    )
+    block_sizes = set(tuple(image.block_size) for image in images)
+    strips = all(image.block_size[0] >= image.xi_max - image.xi_min for image in images)
+
+    if strips:
+        block_y = max(block_y for _, block_y in block_sizes)
+        rows = max(int(round(chunksize**2 / wrapper_x / block_y)), 1) * block_y
+        phase = most_common([image.yi_min % block_y for image in images])
+        chunks = (axis_chunks(wrapper_y, rows, phase), (wrapper_x,))
+        layout = "strips of {} rows, chunks of {} full width rows".format(block_y, rows)
+    elif len(block_sizes) == 1:
+        block_x, block_y = block_sizes.pop()
+        chunk_y = max(int(round(chunksize / block_y)), 1) * block_y
+        chunk_x = max(int(round(chunksize / block_x)), 1) * block_x
+        phase_y = most_common([image.yi_min % block_y for image in images])
+        phase_x = most_common([image.xi_min % block_x for image in images])
+        chunks = (
+            axis_chunks(wrapper_y, chunk_y, phase_y),
+            axis_chunks(wrapper_x, chunk_x, phase_x),
+        )
+        layout = "tiles of {}x{}, chunks of {}x{}".format(
+            block_x, block_y, chunk_x, chunk_y
+        )
+    else:
+        print(
+            "  chunks grid: square chunks, the images don't have a common block layout"
+        )
+        return square_chunks
+
+    print(
+        "  chunks grid: aligned to {}, {} chunks, blocks decoded: {} (square chunks: {})".format(
+            layout,
+            len(chunks[0]) * len(chunks[1]),
+            decoded_blocks(images, *chunks),
+            decoded_blocks(images, *square_chunks),
+        )
+    )
+    return chunks
+
+
+def output_block_size(chunks):
+    """
+    Return the block size (x, y) of the tiled output for the chunks grid
+    ((y chunks), (x chunks)): the largest of OUTPUT_BLOCK_SIZES that divides
+    the limits between the chunks along each axis, so each chunk writes
+    whole tiles and each tile is written by only one chunk. If no size
+    divides the limits (chunks not aligned to 16 pixels) it is 256.
+    """
+    block_size = []
+    for sizes in (chunks[1], chunks[0]):
+        limits = np.cumsum(sizes)[:-1]
+        # without limits (one chunk) any size is aligned
+        step = int(np.gcd.reduce(limits)) if len(limits) else 0
+        block_size.append(
+            next((size for size in OUTPUT_BLOCK_SIZES if step % size == 0), 256)
+        )
+    return tuple(block_size)
@@ -10,12 +10,84 @@
 #  (at your option) any later version.
 #
 import os
+import threading
+from collections import OrderedDict
 
 import numpy as np
 from osgeo import gdal
 
 from .parse import parse_filename
 
+# maximum number of GDAL datasets kept open at the same time by each thread
+MAX_OPEN_DATASETS = 256
+
+# numpy types of the GDAL integer data types
+GDAL_INTEGER_TYPES = {
+    gdal.GDT_Byte: np.uint8,
+    gdal.GDT_UInt16: np.uint16,
+    gdal.GDT_Int16: np.int16,
+    gdal.GDT_UInt32: np.uint32,
+    gdal.GDT_Int32: np.int32,
+}
+
+
+class DatasetPool:
+    """
+    Least recently used cache of opened GDAL datasets.
+
+    GDAL datasets can't be shared across processes and are not thread-safe,
+    so each thread of each process keeps its own handles. The pool is reset
+    when it is used from a new process id.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_DATASETS):
+        self.max_open = max_open
+        self.pid = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.threads_datasets = []
+
+    @property
+    def datasets(self):
+        if self.pid != os.getpid():
+            # new worker, drop the handles inherited from the parent process
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.local = threading.local()
+                    self.threads_datasets = []
+        if not hasattr(self.local, "datasets"):
+            self.local.datasets = OrderedDict()
+            with self.lock:
+                self.threads_datasets.append(self.local.datasets)
+        return self.local.datasets
+
+    def get(self, file_path):
+        # the file path can be also the XML of a VRT
+        datasets = self.datasets
+        if file_path in datasets:
+            datasets.move_to_end(file_path)
+            return datasets[file_path]
+
+        gdal_file = gdal.Open(file_path, gdal.GA_ReadOnly)
+        datasets[file_path] = gdal_file
+        # close the least recently used datasets above the limit
+        while len(datasets) > self.max_open:
+            datasets.popitem(last=False)
+        return gdal_file
+
+    def clear(self):
+        """
+        Close the datasets opened by all threads of this process, it must
+        be called when the threads are not reading.
+        """
+        with self.lock:
+            for datasets in self.threads_datasets:
+                datasets.clear()
+
+
+dataset_pool = DatasetPool()
+
 
 class Image:
     # global wrapper matrix properties
@@ -27,6 +99,20 @@ class Image:
     projection = None
     # no data values from arguments
     nodata_from_arg = None
+    # filter applied to the bands of each chunk read (see read_filtered)
+    chunk_filter = None
+    # read the images through VRTs in the wrapper grid (see set_vrt)
+    vrt = False
+    # the global properties above, set again in the worker processes
+    global_properties = [
+        "wrapper_extent",
+        "wrapper_x_res",
+        "wrapper_y_res",
+        "wrapper_shape",
+        "projection",
+        "nodata_from_arg",
+        "chunk_filter",
+    ]
 
     def __init__(self, file_path):
         self.file_path = self.get_dataset_path(file_path)
@@ -43,12 +129,45 @@ class Image:
         self.y_res = abs(float(y_res))
         # number of bands
         self.n_bands = gdal_file.RasterCount
+        # no data values from file for each band
+        self.nodata_from_file = [
+            gdal_file.GetRasterBand(band).GetNoDataValue()
+            for band in range(1, self.n_bands + 1)
+        ]
+        # block size (x, y) of the first band, the tiles or strips of the file
+        self.block_size = gdal_file.GetRasterBand(1).GetBlockSize()
+        # numpy type of the bands if all are integers, else None
+        data_types = [
+            gdal_file.GetRasterBand(band).DataType
+            for band in range(1, self.n_bands + 1)
+        ]
+        if all(data_type in GDAL_INTEGER_TYPES for data_type in data_types):
+            self.integer_type = np.result_type(
+                *[GDAL_INTEGER_TYPES[data_type] for data_type in data_types]
+            )
+        else:
+            self.integer_type = None
         # projection
         if Image.projection is None:
             Image.projection = gdal_file.GetProjectionRef()
         del gdal_file
         # output type
         self.output_type = None
+        # in-memory VRT of the image in the wrapper grid (see set_vrt)
+        self.vrt_xml = None
+
+    @classmethod
+    def get_global_properties(cls):
+        return {name: getattr(cls, name) for name in cls.global_properties}
+
+    @classmethod
+    def set_global_properties(cls, properties):
+        """
+        Set the global properties of the images, the class attributes are
+        not sent with the images to the worker processes.
+        """
+        for name, value in properties.items():
+            setattr(cls, name, value)
 
     @staticmethod
     def get_dataset_path(file_path):
@@ -81,6 +200,54 @@ class Image:
             - (self.extent[3] - Image.wrapper_extent[3]) / Image.wrapper_y_res
         )
 
+    def set_vrt(self):
+        """
+        Build an in-memory VRT of the image in the wrapper grid: the extent
+        snapped outward to the pixels of the wrapper and the wrapper pixel
+        size, GDAL resamples (nearest) the image if it has a different pixel
+        size. The image is read from the VRT, opened by its XML. The block
+        size is the one of the file scaled to the wrapper pixel size.
+        """
+        wrapper_min_x = Image.wrapper_extent[0]
+        wrapper_max_y = Image.wrapper_extent[1]
+        x_res, y_res = Image.wrapper_x_res, Image.wrapper_y_res
+        # pixels of the wrapper from the left-upper corner, with a tolerance
+        # for the floating point errors
+        x_min = np.floor((self.extent[0] - wrapper_min_x) / x_res + 1e-6)
+        y_min = np.floor((wrapper_max_y - self.extent[1]) / y_res + 1e-6)
+        x_max = np.ceil((self.extent[2] - wrapper_min_x) / x_res - 1e-6)
+        y_max = np.ceil((wrapper_max_y - self.extent[3]) / y_res - 1e-6)
+        extent = [
+            wrapper_min_x + x_min * x_res,
+            wrapper_max_y - y_min * y_res,
+            wrapper_min_x + x_max * x_res,
+            wrapper_max_y - y_max * y_res,
+        ]
+
+        vrt = gdal.BuildVRT(
+            "",
+            [self.file_path],
+            outputBounds=(extent[0], extent[3], extent[2], extent[1]),
+            xRes=x_res,
+            yRes=y_res,
+            resampleAlg="nearest",
+        )
+        self.vrt_xml = vrt.GetMetadata("xml:VRT")[0]
+        del vrt
+        # the blocks decoded are the ones of the file, not the blocks of the
+        # VRT (128x128), in the pixels of the wrapper
+        block_x, block_y = self.block_size
+        if block_x >= round((self.extent[2] - self.extent[0]) / self.x_res):
+            # strips of the full width
+            block_x = int(x_max - x_min)
+        else:
+            block_x = max(int(round(block_x * self.x_res / x_res)), 1)
+        block_y = max(int(round(block_y * self.y_res / y_res)), 1)
+        self.block_size = [block_x, block_y]
+        self.extent = extent
+        self.x_res = x_res
+        self.y_res = y_res
+
     def set_metadata_from_filename(self):
         (
             self.landsat_version,
@@ -91,48 +258,149 @@ class Image:
             self.jday,
         ) = parse_filename(self.file_path)
 
-    def get_chunk(self, band, xoff, xsize, yoff, ysize):
+    def get_range(self, bands):
         """
-        Get the array of the band for the respective chunk.
+        Return the exact range (min, max) of the values of the bands without
+        the no data value of the file, from the statistics saved in the file
+        if they are not approximate, else computed by GDAL reading the whole
+        band. Return None if all the values are no data.
         """
         gdal_file = gdal.Open(self.file_path, gdal.GA_ReadOnly)
-        raster_band = gdal_file.GetRasterBand(band).ReadAsArray(
-            xoff, yoff, xsize, ysize
+        band_ranges = []
+        for band in bands:
+            raster_band = gdal_file.GetRasterBand(band)
+            minimum = raster_band.GetMetadataItem("STATISTICS_MINIMUM")
+            maximum = raster_band.GetMetadataItem("STATISTICS_MAXIMUM")
+            approximate = raster_band.GetMetadataItem("STATISTICS_APPROXIMATE")
+            if minimum is not None and maximum is not None and approximate != "YES":
+                band_range = (float(minimum), float(maximum))
+            else:
+                try:
+                    band_range = raster_band.ComputeRasterMinMax(False)
+                except RuntimeError:
+                    # all the values are no data
+                    continue
+            if band_range is not None and np.isfinite(band_range).all():
+                band_ranges.append(band_range)
+        del gdal_file
+        if not band_ranges:
+            return None
+        return (
+            min(band_range[0] for band_range in band_ranges),
+            max(band_range[1] for band_range in band_ranges),
         )
-        raster_band = raster_band.astype(np.float32)
 
-        # convert the no data values from file to NaN
-        nodata_from_file = gdal_file.GetRasterBand(band).GetNoDataValue()
+    def get_nodata_mask(self, raster_band, band):
+        """
+        Return the boolean mask of the no data values of the raster band,
+        from file and from arguments.
+        """
+        # no data values from file, or from the filter for the filtered values
+        nodata_from_file = self.nodata_from_file[band - 1]
+        if Image.chunk_filter is not None and Image.chunk_filter.nodata is not None:
+            nodata_from_file = Image.chunk_filter.nodata
         if nodata_from_file is not None:
-            raster_band[raster_band == nodata_from_file] = np.nan
+            nodata_mask = raster_band == nodata_from_file
+        else:
+            nodata_mask = np.zeros(raster_band.shape, dtype=bool)
 
-        # convert the no data values set from arguments to NaN
+        # no data values set from arguments
         if (
             Image.nodata_from_arg is not None
             and Image.nodata_from_arg != nodata_from_file
         ):
             if isinstance(Image.nodata_from_arg, (int, float)):
-                raster_band[raster_band == Image.nodata_from_arg] = np.nan
+                nodata_mask |= raster_band == Image.nodata_from_arg
             else:
                 for condition in Image.nodata_from_arg:
                     if condition[0] == "<":
-                        raster_band[raster_band < condition[1]] = np.nan
+                        nodata_mask |= raster_band < condition[1]
                     elif condition[0] == "<=":
-                        raster_band[raster_band <= condition[1]] = np.nan
+                        nodata_mask |= raster_band <= condition[1]
                     elif condition[0] == ">":
-                        raster_band[raster_band > condition[1]] = np.nan
+                        nodata_mask |= raster_band > condition[1]
                     elif condition[0] == ">=":
-                        raster_band[raster_band >= condition[1]] = np.nan
+                        nodata_mask |= raster_band >= condition[1]
                     elif condition[0] == "==":
-                        raster_band[raster_band == condition[1]] = np.nan
+                        nodata_mask |= raster_band == condition[1]
 
-        del gdal_file
+        return nodata_mask
 
-        return raster_band
+    def get_chunk(self, bands, xoff, xsize, yoff, ysize, out=None, valid=None):
+        """
+        Get the array of the bands for the respective chunk, with the shape
+        (bands, y, x). All the bands are read at once and converted to float32
+        into out, a new array if it is None, with the no data values as NaN.
 
-    def get_chunk_in_wrapper(self, band, xc, xc_size, yc, yc_size):
+        If valid is given, out keeps the native integer type of the image and
+        the no data values are set as False in valid instead.
         """
-        Get the array of the band adjusted into the wrapper matrix for the respective chunk.
+        if out is None:
+            out = np.empty((len(bands), ysize, xsize), dtype=np.float32)
+        gdal_file = dataset_pool.get(self.vrt_xml or self.file_path)
+        raster_bands = out
+        if Image.chunk_filter is None:
+            raster_bands[:] = gdal_file.ReadAsArray(
+                xoff, yoff, xsize, ysize, band_list=bands
+            ).reshape(len(bands), ysize, xsize)
+        else:
+            raster_bands[:] = self.read_filtered(
+                gdal_file, bands, xoff, xsize, yoff, ysize
+            )
+
+        for band_idx, band in enumerate(bands):
+            nodata_mask = self.get_nodata_mask(raster_bands[band_idx], band)
+            if valid is None:
+                # convert the no data values to NaN
+                raster_bands[band_idx][nodata_mask] = np.nan
+            else:
+                valid[band_idx] = ~nodata_mask
+
+        return raster_bands
+
+    def read_filtered(self, gdal_file, bands, xoff, xsize, yoff, ysize):
+        """
+        Read the bands of the window with a halo of chunk_filter.halo pixels,
+        cut at the edges of the image, and return the window of the bands
+        filtered with chunk_filter, a callable that takes and returns the
+        2D array of a band. The window is equal to the same window of the
+        whole image filtered at once, so filters as a morphological closing
+        can be applied on the fly instead of writing the filtered images.
+        The chunk_filter.nodata is the no data value of the filtered values,
+        None to use the no data value of the file.
+        """
+        halo = Image.chunk_filter.halo
+        x_min = max(xoff - halo, 0)
+        y_min = max(yoff - halo, 0)
+        x_max = min(xoff + xsize + halo, gdal_file.RasterXSize)
+        y_max = min(yoff + ysize + halo, gdal_file.RasterYSize)
+        raster_bands = gdal_file.ReadAsArray(
+            x_min, y_min, x_max - x_min, y_max - y_min, band_list=bands
+        ).reshape(len(bands), y_max - y_min, x_max - x_min)
+
+        # the window without the halo
+        y_start = yoff - y_min
+        x_start = xoff - x_min
+        return np.array(
+            [
+                Image.chunk_filter(raster_band)[
+                    y_start : y_start + ysize, x_start : x_start + xsize
+                ]
+                for raster_band in raster_bands
+            ]
+        )
+
+    def get_chunk_in_wrapper(
+        self, bands, xc, xc_size, yc, yc_size, out=None, valid=None
+    ):
+        """
+        Get the array of the bands adjusted into the wrapper matrix for the respective chunk.
+
+        If out is given, an array (bands, yc_size, xc_size) already filled
+        with nan, the data is written directly in it, else a new float32 array
+        is created. For the masked integer path, out is an integer array and
+        valid its boolean mask initialized as False (see get_chunk). Return
+        None if the chunk is outside of the image.
         """
         # bounds for chunk with respect to wrapper
         # the 0,0 is left-upper corner
@@ -151,7 +419,9 @@ class Image:
             return None
         else:
             # initialize the chunk with a nan matrix
-            chunk_matrix = np.full((yc_size, xc_size), np.nan)
+            if out is None:
+                out = np.full((len(bands), yc_size, xc_size), np.nan, dtype=np.float32)
+            chunk_matrix = out
 
             # set bounds for get the array chunk in image
             xoff = 0 if xc_min <= self.xi_min else xc_min - self.xi_min
@@ -184,8 +454,14 @@ class Image:
             y_max = y_min + ysize if y_min + ysize < yc_max else yc_max
 
             # fill with the chunk data of the image in the corresponding position
-            chunk_matrix[y_min:y_max, x_min:x_max] = self.get_chunk(
-                band, xoff, xsize, yoff, ysize
+            self.get_chunk(
+                bands,
+                xoff,
+                xsize,
+                yoff,
+                ysize,
+                out=chunk_matrix[:, y_min:y_max, x_min:x_max],
+                valid=None if valid is None else valid[:, y_min:y_max, x_min:x_max],
             )
 
             return chunk_matrix
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2016-2018 Xavier Corredor Llano, SMBYC
+#  Email: xcorredorl at ideam.gov.co
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+import datetime
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .cache import image_fingerprint
+from .image import Image
+from .stats import statistic
+
+# statistics that can be derived from the incremental state
+INCREMENTAL_STATS = [
+    "mean",
+    "std",
+    "valid_pixels",
+    "min",
+    "max",
+    "last_pixel",
+    "jday_last_pixel",
+]
+
+# the rasters (bands, y, x) of the state: name, statistic that compute it
+# for the new images, data type and initial value
+STATE_ARRAYS = [
+    ("count", "valid_pixels", np.uint32, 0),
+    ("sum", "sum", np.float64, 0),
+    ("sum_squares", "sum_squares", np.float64, 0),
+    ("min", "min", np.float64, np.nan),
+    ("max", "max", np.float64, np.nan),
+    ("last_day", "last_day", np.int32, 0),
+    ("last_value", "last_pixel", np.float64, np.nan),
+]
+
+MANIFEST = "manifest.json"
+
+# ordinal of the numpy datetime64 epoch
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def state_properties(bands):
+    """
+    Properties of the wrapper, bands, no data values, chunk filter and VRT
+    reading of the state, if any of them changes the state is computed
+    again from all images.
+    """
+    properties = {
+        "extent": Image.wrapper_extent,
+        "x_res": Image.wrapper_x_res,
+        "y_res": Image.wrapper_y_res,
+        "shape": Image.wrapper_shape,
+        "bands": bands,
+        "nodata": Image.nodata_from_arg,
+        "chunk_filter": repr(Image.chunk_filter),
+        "vrt": Image.vrt,
+    }
+    # as it is loaded from the manifest
+    return json.loads(json.dumps(properties))
+
+
+def load_manifest(state_dir):
+    manifest_path = os.path.join(state_dir, MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(state_dir, manifest):
+    manifest_path = os.path.join(state_dir, MANIFEST)
+    tmp_path = os.path.join(state_dir, "." + MANIFEST + ".tmp")
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, manifest_path)
+
+
+def open_state(state_dir, images, bands):
+    """
+    Open the rasters of the state as memory maps, return them with the
+    manifest and the images that are not yet in the state. The state is
+    reset if its properties changed, if an image in it was modified or
+    removed, or if its last update was not completed.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    properties = state_properties(bands)
+    images_paths = []
+    fingerprints = {}
+    for image in images:
+        path, mtime, size = image_fingerprint(image)
+        images_paths.append(path)
+        fingerprints[path] = [mtime, size]
+
+    manifest = load_manifest(state_dir)
+    reset = (
+        manifest is None
+        or not manifest["completed"]
+        or manifest["properties"] != properties
+        or any(
+            fingerprints.get(path) != fingerprint
+            for path, fingerprint in manifest["images"].items()
+        )
+    )
+    if reset:
+        manifest = {"properties": properties, "images": {}, "completed": True}
+
+    shape = (len(bands),) + tuple(Image.wrapper_shape)
+    arrays = {}
+    for name, _, data_type, initial in STATE_ARRAYS:
+        array_path = os.path.join(state_dir, name + ".npy")
+        if reset:
+            arrays[name] = open_memmap(
+                array_path, mode="w+", dtype=data_type, shape=shape
+            )
+            arrays[name][:] = initial
+        else:
+            arrays[name] = open_memmap(array_path, mode="r+")
+
+    new_images = [
+        image
+        for image, path in zip(images, images_paths)
+        if path not in manifest["images"]
+    ]
+    new_fingerprints = {
+        path: fingerprints[path]
+        for path in images_paths
+        if path not in manifest["images"]
+    }
+    return arrays, manifest, new_images, new_fingerprints
+
+
+def update_state(
+    state_dir, images, bands, num_process, chunksize, scheduler, group_dates=False
+):
+    """
+    Add to the state in state_dir the images that are not yet in it, only
+    the new images are read. With group_dates the new images of the same
+    date are added as one layer, the images of a date must be added in the
+    same update. Return the rasters of the state.
+    """
+    arrays, manifest, new_images, new_fingerprints = open_state(
+        state_dir, images, bands
+    )
+    print(
+        "  images in the incremental state: {}, new images to add: {}".format(
+            len(manifest["images"]), len(new_images)
+        )
+    )
+    if not new_images:
+        return arrays
+
+    # the state is not valid until the update is completed
+    manifest["completed"] = False
+    save_manifest(state_dir, manifest)
+
+    state_names = [name for name, _, _, _ in STATE_ARRAYS]
+    state_stats = [stat for _, stat, _, _ in STATE_ARRAYS]
+
+    def merge(block, yc, xc):
+        if np.isnan(block).all():
+            # chunk without new images
+            return
+        window = (slice(yc, yc + block.shape[1]), slice(xc, xc + block.shape[2]))
+        for band_idx in range(len(bands)):
+            first = band_idx * len(state_stats)
+            new = dict(zip(state_names, block[first : first + len(state_stats)]))
+            state = {name: array[band_idx][window] for name, array in arrays.items()}
+            state["count"] += new["count"].astype(np.uint32)
+            state["sum"] += new["sum"]
+            state["sum_squares"] += new["sum_squares"]
+            np.fmin(state["min"], new["min"], out=state["min"])
+            np.fmax(state["max"], new["max"], out=state["max"])
+            # the last pixel of the new images if it is the most recent
+            newer = (new["last_day"] > 0) & (new["last_day"] >= state["last_day"])
+            state["last_day"][newer] = new["last_day"][newer]
+            state["last_value"][newer] = new["last_value"][newer]
+
+    statistic(
+        state_stats,
+        new_images,
+        bands,
+        num_process,
+        chunksize,
+        on_block=merge,
+        scheduler=scheduler,
+        group_dates=group_dates,
+    )
+    for array in arrays.values():
+        array.flush()
+
+    manifest["images"].update(new_fingerprints)
+    manifest["completed"] = True
+    save_manifest(state_dir, manifest)
+    return arrays
+
+
+def state_statistic(stat, arrays, band_idx, rows):
+    """
+    Derive the statistic from the rasters of the state for the band and
+    the rows slice, the pixels without valid values are nan (0 for
+    jday_last_pixel) as in get_stat_func.
+    """
+    count = arrays["count"][band_idx, rows].astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = arrays["sum"][band_idx, rows] / count
+
+    if stat == "valid_pixels":
+        return count
+    if stat == "mean":
+        return mean
+    if stat == "std":
+        # population standard deviation as np.nanstd
+        with np.errstate(invalid="ignore"):
+            variance = arrays["sum_squares"][band_idx, rows] / count - mean**2
+        return np.sqrt(np.maximum(variance, 0))
+    if stat in ("min", "max"):
+        return np.array(arrays[stat][band_idx, rows])
+    if stat == "last_pixel":
+        return np.array(arrays["last_value"][band_idx, rows])
+    if stat == "jday_last_pixel":
+        last_day = arrays["last_day"][band_idx, rows]
+        dates = (last_day - EPOCH_ORDINAL).astype("datetime64[D]")
+        jday = (dates - dates.astype("datetime64[Y]")).astype(int) + 1
+        return np.where(last_day > 0, jday, 0)
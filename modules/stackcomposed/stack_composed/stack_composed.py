@@ -27,8 +27,16 @@ import numpy as np
 from dask.diagnostics import ProgressBar
 from osgeo import gdal, osr
 
+from .cache import MAX_CACHE_SIZE, cache_chunksize, prune_cache
+from .chunks import output_block_size, plan_chunks, plan_chunksize
 from .image import Image
-from .stats import statistic
+from .incremental import (
+    INCREMENTAL_STATS,
+    STATE_ARRAYS,
+    state_statistic,
+    update_state,
+)
+from .stats import METADATA_STATS, SCHEDULERS, is_quantile_stat, statistic
 
 IMAGES_TYPES = (".tif", ".TIF", ".img", ".IMG", ".hdr", ".HDR")
 STATS = [
@@ -46,6 +54,62 @@ STATS = [
 ]
 
 
+def get_output_type(stat, output_type, n_images):
+    """
+    Return the GDAL data type for save the statistic, by default it is
+    chosen based on the statistic.
+    """
+    if output_type is None:
+        if stat in [
+            "median",
+            "mean",
+            "gmean",
+            "max",
+            "min",
+            "last_pixel",
+            "jday_last_pixel",
+            "jday_median",
+        ] or stat.startswith(("percentile_", "trim_mean_")):
+            return gdal.GDT_UInt16
+        if stat in ["std", "snr"]:
+            return gdal.GDT_Float32
+        if stat in ["valid_pixels"]:
+            if n_images < 256:
+                return gdal.GDT_Byte
+            else:
+                return gdal.GDT_UInt16
+        if stat in ["linear_trend"]:
+            return gdal.GDT_Int32
+    else:
+        if output_type == "byte":
+            return gdal.GDT_Byte
+        if output_type == "uint16":
+            return gdal.GDT_UInt16
+        if output_type == "uint32":
+            return gdal.GDT_UInt32
+        if output_type == "int16":
+            return gdal.GDT_Int16
+        if output_type == "int32":
+            return gdal.GDT_Int32
+        if output_type == "float32":
+            return gdal.GDT_Float32
+        if output_type == "float64":
+            return gdal.GDT_Float64
+
+
+def get_nodata(stats, gdal_output_type):
+    """
+    Return the nodata value for save the statistics in the output type.
+    """
+    # set nodata value special by statistic
+    if stats == ["linear_trend"]:
+        return -2147483648
+    # set nodata value depend of the output type
+    if gdal_output_type in [gdal.GDT_Float32, gdal.GDT_Float64]:
+        return np.nan
+    return 0
+
+
 def run(
     stat,
     bands,
@@ -57,35 +121,86 @@ def run(
     chunksize=None,
     start_date=None,
     end_date=None,
+    streaming=False,
+    multiband=False,
+    scheduler="processes",
+    cache_dir=None,
+    cache_max_size=MAX_CACHE_SIZE,
+    state_dir=None,
+    quantile_bins=None,
+    quantile_range=None,
+    vrt=False,
+    group_dates=False,
+    chunk_filter=None,
 ):
     # ignore warnings
     warnings.filterwarnings("ignore")
 
+    # load statistics, one or several comma separated, all of them are
+    # computed reading the images once
+    if isinstance(stat, str):
+        stats = [s.strip() for s in stat.split(",")]
+    else:
+        stats = list(stat)
+
     # check statistical option
-    if stat not in STATS and not stat.startswith(("percentile_", "trim_mean_")):
-        print("\nError: argument '-stat' invalid choice: {}".format(stat))
-        print(
-            "choose from: median, mean, gmean, max, min, std, valid_pixels, last_pixel, "
-            "jday_last_pixel, jday_median, linear_trend, percentile_NN, trim_mean_LL_UL"
-        )
-        return
-    if stat.startswith("percentile_"):
-        try:
-            int(stat.split("_")[1])
-        except:
-            print("\nError: argument '-stat' invalid choice: {}".format(stat))
-            print("the percentile must ends with a valid number, e.g. percentile_25")
-            return
-    if stat.startswith("trim_mean_"):
-        try:
-            int(stat.split("_")[2])
-            int(stat.split("_")[3])
-        except:
+    for stat in stats:
+        if stat not in STATS and not stat.startswith(("percentile_", "trim_mean_")):
             print("\nError: argument '-stat' invalid choice: {}".format(stat))
             print(
-                "the trim_mean_LL_UL must ends with a valid limits, e.g. trim_mean_10_80"
+                "choose from: median, mean, gmean, max, min, std, valid_pixels, last_pixel, "
+                "jday_last_pixel, jday_median, linear_trend, percentile_NN, trim_mean_LL_UL"
             )
             return
+        if stat.startswith("percentile_"):
+            try:
+                int(stat.split("_")[1])
+            except:
+                print("\nError: argument '-stat' invalid choice: {}".format(stat))
+                print(
+                    "the percentile must ends with a valid number, e.g. percentile_25"
+                )
+                return
+        if stat.startswith("trim_mean_"):
+            try:
+                int(stat.split("_")[2])
+                int(stat.split("_")[3])
+            except:
+                print("\nError: argument '-stat' invalid choice: {}".format(stat))
+                print(
+                    "the trim_mean_LL_UL must ends with a valid limits, e.g. trim_mean_10_80"
+                )
+                return
+
+    # check the statistics for the incremental mode
+    if state_dir is not None:
+        for stat in stats:
+            if stat not in INCREMENTAL_STATS:
+                print(
+                    "\nError: the statistic '{}' is not supported in the incremental mode".format(
+                        stat
+                    )
+                )
+                print("choose from: {}".format(", ".join(INCREMENTAL_STATS)))
+                return
+
+    # check the statistics for the approximate quantiles
+    if quantile_bins is not None:
+        for stat in stats:
+            if not is_quantile_stat(stat):
+                print(
+                    "\nError: the statistic '{}' is not supported with the approximate quantiles".format(
+                        stat
+                    )
+                )
+                print("choose from: median, percentile_NN")
+                return
+
+    # check scheduler option
+    if scheduler not in SCHEDULERS:
+        print("\nError: argument '-scheduler' invalid choice: {}".format(scheduler))
+        print("choose from: {}".format(", ".join(SCHEDULERS)))
+        return
 
     # Read images from file
     images_files = []
@@ -104,6 +219,10 @@ def run(
 
     # save nodata set from arguments
     Image.nodata_from_arg = nodata
+    # filter applied on the fly to the chunks read from the images
+    Image.chunk_filter = chunk_filter
+    # images read through VRTs in the wrapper grid
+    Image.vrt = vrt
 
     # get wrapper extent
     min_x = min([image.extent[0] for image in images])
@@ -139,7 +258,75 @@ def run(
             Image.wrapper_shape[1], Image.wrapper_shape[0]
         )
     )
-    print("  running in {0} cores with chunks size {1}".format(num_process, chunksize))
+    # for some statistics that required filename as metadata, the
+    # incremental state saves the date of the last pixel and the date
+    # grouping mosaics the images of the same date
+    if set(stats) & set(METADATA_STATS) or state_dir is not None or group_dates:
+        [image.set_metadata_from_filename() for image in images]
+    n_layers = None
+    if group_dates:
+        n_layers = len(set(image.date for image in images))
+        print("  dates to process: {0} (images grouped by date)".format(n_layers))
+    if chunksize == "auto":
+        # the incremental mode computes the statistics of its state
+        if state_dir is not None:
+            plan_stats = [stat for _, stat, _, _ in STATE_ARRAYS]
+        else:
+            plan_stats = stats
+        chunksize = plan_chunksize(
+            images, len(bands), plan_stats, num_process, quantile_bins, n_layers
+        )
+        if cache_dir is not None:
+            # the same chunks of the previous runs while they fit in memory
+            chunksize = cache_chunksize(cache_dir, chunksize)
+    print(
+        "  running in {0} cores ({1}) with chunks size {2}".format(
+            num_process, scheduler, chunksize
+        )
+    )
+    if cache_dir is not None:
+        print(
+            "  chunks cache: {} (max {:.1f} GB)".format(
+                cache_dir, cache_max_size / 1024**3
+            )
+        )
+    if state_dir is not None:
+        print("  incremental state: {}".format(state_dir))
+    if vrt:
+        print("  reading the images through VRTs in the wrapper grid")
+    if chunk_filter is not None:
+        print("  filter of the chunks: {}".format(chunk_filter))
+    if quantile_bins is not None:
+        # by default the exact range of the values of the images, not of their
+        # data type, the bins are narrower and so the error, and all the values
+        # are in the range
+        if quantile_range is None:
+            image_ranges = [image.get_range(bands) for image in images]
+            image_ranges = [
+                image_range for image_range in image_ranges if image_range is not None
+            ]
+            if not image_ranges:
+                print(
+                    "\n\nError: the images don't have valid values to set the range\n"
+                    "of the approximate quantiles, set it with -quantile_range\n"
+                )
+                exit(1)
+            quantile_range = (
+                min(image_range[0] for image_range in image_ranges),
+                max(image_range[1] for image_range in image_ranges),
+            )
+            if all(image.integer_type is not None for image in images):
+                # each bin centered in integer values
+                quantile_range = (quantile_range[0] - 0.5, quantile_range[1] + 0.5)
+        print(
+            "  approximate quantiles: {} bins in the range {:g} to {:g} "
+            "(error <= {:g} for the values in the range)".format(
+                quantile_bins,
+                quantile_range[0],
+                quantile_range[1],
+                (quantile_range[1] - quantile_range[0]) / quantile_bins / 2,
+            )
+        )
 
     # check
     print("  checking bands and pixel size: ", flush=True, end="")
@@ -152,12 +339,13 @@ def run(
                     )
                 )
                 exit(1)
-        if round(image.x_res, 1) != round(Image.wrapper_x_res, 1) or round(
-            image.y_res, 1
-        ) != round(Image.wrapper_y_res, 1):
+        if (
+            round(image.x_res, 1) != round(Image.wrapper_x_res, 1)
+            or round(image.y_res, 1) != round(Image.wrapper_y_res, 1)
+        ) and not vrt:
             print(
                 "\n\nError: the image '{}' don't have the same pixel size to the base image: {}x{} vs {}x{}."
-                " The stack-composed is not enabled for process yet images with different pixel size.\n".format(
+                " Use the VRT option for resample the images to the base pixel size.\n".format(
                     image.file_path,
                     round(image.x_res, 1),
                     round(image.y_res, 1),
@@ -168,130 +356,201 @@ def run(
             exit(1)
     print("ok")
 
+    # read the images through VRTs in the wrapper grid, resampled to the
+    # wrapper pixel size
+    if vrt:
+        [image.set_vrt() for image in images]
+
     # set bounds for all images
     [image.set_bounds() for image in images]
 
-    # for some statistics that required filename as metadata
-    if stat in ["last_pixel", "jday_last_pixel", "jday_median", "linear_trend"]:
-        [image.set_metadata_from_filename() for image in images]
-    # registered Dask progress bar
-    pbar = ProgressBar()
-    pbar.register()
+    # chunks grid aligned to the blocks (tiles or strips) of the images
+    chunks = plan_chunks(images, chunksize)
+
+    # registered Dask progress bar, in streaming and incremental mode the
+    # progress is reported by chunks
+    progress_bar = not streaming and state_dir is None
+    if progress_bar:
+        pbar = ProgressBar()
+        pbar.register()
 
+    # the outputs to save, each one is a file with the statistics in
+    # its bands, by default one file for each statistic
+    if multiband:
+        outputs_stats = [stats]
+    else:
+        outputs_stats = [[stat] for stat in stats]
+
+    outputs = []
+    output_bands = []
     for band in bands:
-        # check and set the output file before process
-        if os.path.isdir(output):
-            output_filename = os.path.join(
-                output, "stack_composed_{}_band{}.tif".format(stat, band)
-            )
-        elif output.endswith((".tif", ".TIF")) and os.path.isdir(
-            os.path.dirname(output)
-        ):
-            output_filename = output
-        elif output.endswith((".tif", ".TIF")) and os.path.dirname(output) == "":
-            output_filename = os.path.join(os.getcwd(), output)
-        else:
-            print(
-                "\nError: Setting the output filename, wrong directory and/or\n"
-                "       filename: {}\n".format(output)
+        for output_stats in outputs_stats:
+            # check and set the output file before process
+            stats_name = "_".join(output_stats)
+            if output_stats == ["linear_trend"]:
+                stats_name = "linear_trend_x1e6"
+            if os.path.isdir(output):
+                output_filename = os.path.join(
+                    output, "stack_composed_{}_band{}.tif".format(stats_name, band)
+                )
+            elif output.endswith((".tif", ".TIF")) and (
+                os.path.isdir(os.path.dirname(output)) or os.path.dirname(output) == ""
+            ):
+                output_filename = os.path.abspath(output)
+                root, ext = os.path.splitext(output_filename)
+                if len(outputs_stats) > 1:
+                    # one file for each statistic
+                    root = "{}_{}".format(root, stats_name)
+                if len(bands) > 1:
+                    # one file for each band
+                    root = "{}_band{}".format(root, band)
+                output_filename = root + ext
+            else:
+                print(
+                    "\nError: Setting the output filename, wrong directory and/or\n"
+                    "       filename: {}\n".format(output)
+                )
+                exit(1)
+
+            # choose the data type based on the statistics, a file with
+            # different types is saved in float32 if the type is not set
+            output_types = set(
+                get_output_type(stat, output_type, len(images)) for stat in output_stats
             )
-            exit(1)
-        # choose the default data type based on the statistic
-        if output_type is None:
-            if stat in [
-                "median",
-                "mean",
-                "gmean",
-                "max",
-                "min",
-                "last_pixel",
-                "jday_last_pixel",
-                "jday_median",
-            ] or stat.startswith(("percentile_", "trim_mean_")):
-                gdal_output_type = gdal.GDT_UInt16
-            if stat in ["std", "snr"]:
-                gdal_output_type = gdal.GDT_Float32
-            if stat in ["valid_pixels"]:
-                if len(images) < 256:
-                    gdal_output_type = gdal.GDT_Byte
-                else:
-                    gdal_output_type = gdal.GDT_UInt16
-            if stat in ["linear_trend"]:
-                gdal_output_type = gdal.GDT_Int32
-        else:
-            if output_type == "byte":
-                gdal_output_type = gdal.GDT_Byte
-            if output_type == "uint16":
-                gdal_output_type = gdal.GDT_UInt16
-            if output_type == "uint32":
-                gdal_output_type = gdal.GDT_UInt32
-            if output_type == "int16":
-                gdal_output_type = gdal.GDT_Int16
-            if output_type == "int32":
-                gdal_output_type = gdal.GDT_Int32
-            if output_type == "float32":
+            if len(output_types) == 1:
+                gdal_output_type = output_types.pop()
+            else:
                 gdal_output_type = gdal.GDT_Float32
-            if output_type == "float64":
-                gdal_output_type = gdal.GDT_Float64
-        for image in images:
-            image.output_type = gdal_output_type
-        ### process ###
-        # Calculate the statistics
-        print("\nProcessing the {} for band {}:".format(stat, band))
-        output_array = statistic(stat, images, band, num_process, chunksize)
-
-        ### save result ###
-        # create output raster
-        driver = gdal.GetDriverByName("GTiff")
-        nbands = 1
-        outRaster = driver.Create(
-            output_filename,
-            Image.wrapper_shape[1],
-            Image.wrapper_shape[0],
-            nbands,
-            gdal_output_type,
-        )
-        outband = outRaster.GetRasterBand(nbands)
+            for image in images:
+                image.output_type = gdal_output_type
 
-        # convert nan value and set nodata value special by statistic
-        if stat in ["linear_trend"]:
-            output_array[np.isnan(output_array)] = -2147483648
-            outband.SetNoDataValue(-2147483648)
-            output_filename = output_filename.replace(
-                "stack_composed_linear_trend_band",
-                "stack_composed_linear_trend_x1e6_band",
+            ### create output raster ###
+            driver = gdal.GetDriverByName("GTiff")
+            nbands = len(output_stats)
+            if streaming:
+                # tiled output for write each chunk in its own tiles
+                block_x, block_y = output_block_size(chunks)
+                creation_options = [
+                    "TILED=YES",
+                    "BLOCKXSIZE={}".format(block_x),
+                    "BLOCKYSIZE={}".format(block_y),
+                    "BIGTIFF=IF_SAFER",
+                ]
+            else:
+                creation_options = []
+            outRaster = driver.Create(
+                output_filename,
+                Image.wrapper_shape[1],
+                Image.wrapper_shape[0],
+                nbands,
+                gdal_output_type,
+                creation_options,
             )
-        else:  # set nodata value depend of the output type
-            if gdal_output_type in [
-                gdal.GDT_Byte,
-                gdal.GDT_UInt16,
-                gdal.GDT_UInt32,
-                gdal.GDT_Int16,
-                gdal.GDT_Int32,
-            ]:
-                outband.SetNoDataValue(0)
-            if gdal_output_type in [gdal.GDT_Float32, gdal.GDT_Float64]:
-                outband.SetNoDataValue(np.nan)
-        # write band
-        outband.WriteArray(output_array)
-
-        # set projection and geotransform
-        outRasterSRS = osr.SpatialReference()
-        outRasterSRS.ImportFromWkt(Image.projection)
-        outRaster.SetProjection(outRasterSRS.ExportToWkt())
-        outRaster.SetGeoTransform(
-            (
-                Image.wrapper_extent[0],
-                Image.wrapper_x_res,
-                0,
-                Image.wrapper_extent[1],
+            nodata_value = get_nodata(output_stats, gdal_output_type)
+            for idx, stat in enumerate(output_stats, start=1):
+                outband = outRaster.GetRasterBand(idx)
+                outband.SetNoDataValue(nodata_value)
+                outband.SetDescription(stat)
+
+            # set projection and geotransform
+            outRasterSRS = osr.SpatialReference()
+            outRasterSRS.ImportFromWkt(Image.projection)
+            outRaster.SetProjection(outRasterSRS.ExportToWkt())
+            outRaster.SetGeoTransform(
+                (
+                    Image.wrapper_extent[0],
+                    Image.wrapper_x_res,
+                    0,
+                    Image.wrapper_extent[1],
+                    0,
+                    -Image.wrapper_y_res,
+                )
+            )
+            outputs.append(outRaster)
+            # the result has the statistics in the order of the output bands
+            output_bands += [
+                (outRaster.GetRasterBand(idx), nodata_value)
+                for idx in range(1, nbands + 1)
+            ]
+
+    def write_array(output_array, xoff=0, yoff=0):
+        for stat_array, (outband, nodata_value) in zip(output_array, output_bands):
+            # convert nan value to the nodata value
+            if not np.isnan(nodata_value):
+                stat_array[np.isnan(stat_array)] = nodata_value
+            outband.WriteArray(stat_array, xoff, yoff)
+
+    ### process ###
+    # Calculate the statistics for all bands and save the result
+    print(
+        "\nProcessing the {} for band(s) {}:".format(
+            ", ".join(stats), ",".join([str(b) for b in bands])
+        )
+    )
+    if state_dir is not None:
+        # add the new images to the state and derive the statistics from it
+        # by strips of rows
+        state = update_state(
+            state_dir, images, bands, num_process, chunks, scheduler, group_dates
+        )
+        for yoff in range(0, Image.wrapper_shape[0], chunksize):
+            rows = slice(yoff, yoff + chunksize)
+            write_array(
+                np.array(
+                    [
+                        state_statistic(stat, state, band_idx, rows)
+                        for band_idx in range(len(bands))
+                        for stat in stats
+                    ],
+                    dtype=float,
+                ),
                 0,
-                -Image.wrapper_y_res,
+                yoff,
+            )
+        del state
+    elif streaming:
+        statistic(
+            stats,
+            images,
+            bands,
+            num_process,
+            chunks,
+            on_block=lambda block, yc, xc: write_array(block, xc, yc),
+            scheduler=scheduler,
+            cache_dir=cache_dir,
+            quantile_bins=quantile_bins,
+            quantile_range=quantile_range,
+            group_dates=group_dates,
+        )
+    else:
+        write_array(
+            statistic(
+                stats,
+                images,
+                bands,
+                num_process,
+                chunks,
+                scheduler=scheduler,
+                cache_dir=cache_dir,
+                quantile_bins=quantile_bins,
+                quantile_range=quantile_range,
+                group_dates=group_dates,
             )
         )
 
-        # clean
-        del driver, outRaster, outband, outRasterSRS, output_array
-        # force run garbage collector to release unreferenced memory
-        gc.collect()
+    if cache_dir is not None:
+        deleted = prune_cache(cache_dir, cache_max_size)
+        if deleted:
+            print(
+                "  chunks deleted from the cache (least recently used): {}".format(
+                    deleted
+                )
+            )
+
+    # clean
+    del driver, outRaster, outband, outRasterSRS, outputs, output_bands
+    # force run garbage collector to release unreferenced memory
+    gc.collect()
+    if progress_bar:
+        pbar.unregister()
     print("\nProcess completed!")
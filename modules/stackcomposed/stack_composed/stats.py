@@ -9,130 +9,180 @@
 #  the Free Software Foundation, either version 3 of the License, or
 #  (at your option) any later version.
 #
+import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
 
+import dask
 import dask.array as da
 import numpy as np
 
-from .image import Image
-
-
-def statistic(stat, images, band, num_process, chunksize):
-    # create a empty initial wrapper raster for managed dask parallel
-    # in chunks and storage result
-    wrapper_array = da.empty(Image.wrapper_shape, chunks=chunksize)
-    chunksize = wrapper_array.chunks[0][0]
-
-    # call built in numpy statistical functions, with a specified axis. if
-    # axis=2 means it will Compute along the 'depth' axis, per pixel.
-    # with the return being n by m, the shape of each band.
+from .cache import chunk_key, chunk_path, image_fingerprint, load_chunk, save_chunk
+from .image import Image, dataset_pool
+
+# statistics that required filename as metadata
+METADATA_STATS = ["last_pixel", "jday_last_pixel", "jday_median", "linear_trend"]
+
+# statistics that can be computed from the native integer values with a
+# validity mask, without convert the stack to float (plus the percentiles)
+MASKED_STATS = ["median", "min", "max", "valid_pixels"]
+
+# schedulers for compute the chunks: "processes" computes each chunk in a
+# worker process, "threads" in a thread of the main process (GDAL and numpy
+# release the GIL) and "hybrid" in a worker process that reads the images of
+# the chunk with READER_THREADS threads
+SCHEDULERS = ["processes", "threads", "hybrid"]
+READER_THREADS = 4
+
+# thread pool for read the images of the chunks in the hybrid scheduler,
+# by process id
+_reader_pool = {}
+
+
+def get_reader_pool():
+    """
+    Return the thread pool of the current process for read the images.
+    """
+    pid = os.getpid()
+    if pid not in _reader_pool:
+        _reader_pool.clear()
+        _reader_pool[pid] = ThreadPoolExecutor(READER_THREADS)
+    return _reader_pool[pid]
+
+
+def percentile_from_sorted(stack_sorted, count, q):
+    """
+    Compute the percentile q along the time axis of a stack sorted with the
+    nan values at the end, count is the number of valid values per pixel. It
+    uses the same linear interpolation of np.nanpercentile.
+    """
+    position = (count - 1) * (q / 100.0)
+    index_low = np.maximum(np.floor(position), 0).astype(np.intp)
+    index_high = np.minimum(index_low + 1, np.maximum(count - 1, 0))
+    value_low = np.take_along_axis(stack_sorted, index_low[:, :, np.newaxis], axis=2)
+    value_high = np.take_along_axis(stack_sorted, index_high[:, :, np.newaxis], axis=2)
+    value_low = value_low[:, :, 0].astype(np.float64)
+    value_high = value_high[:, :, 0].astype(np.float64)
+    return value_low + (value_high - value_low) * (position - index_low)
+
+
+def time_last(stack_chunk):
+    """
+    Return a copy of the time-major stack chunk (t, y, x) with the time as
+    the last contiguous axis (y, x, t), faster for sorting along the time.
+    """
+    return np.ascontiguousarray(np.moveaxis(stack_chunk, 0, -1))
+
+
+def last_valid_index(stack_chunk, dates):
+    """
+    Return the position in the stack of the last valid pixel based on the
+    date, and if the pixel has any valid value.
+    """
+    index_sort = np.argsort(dates)[::-1]  # from the most recent to the oldest
+    valid = ~np.isnan(stack_chunk[index_sort])
+    # first valid position from the most recent, 0 if all are nan
+    index = index_sort[np.argmax(valid, axis=0)]
+    return index, valid.any(axis=0)
+
+
+def get_stat_func(stat):
+    """
+    Return the function that compute the statistic for a stack chunk.
+    """
+    # call built in numpy statistical functions, with a specified axis. The
+    # stack chunk is time-major (t, y, x), axis=0 means it will Compute along
+    # the 'depth' axis, per pixel. with the return being n by m, the shape of
+    # each band. The statistics based on sorting use the time as last axis.
     #
 
     # Compute the median
     if stat == "median":
 
         def stat_func(stack_chunk, metadata):
-            return np.nanmedian(stack_chunk, axis=2)
+            return np.nanmedian(time_last(stack_chunk), axis=2)
 
     # Compute the arithmetic mean
     if stat == "mean":
 
         def stat_func(stack_chunk, metadata):
-            return np.nanmean(stack_chunk, axis=2)
+            return np.nanmean(stack_chunk, axis=0, dtype=np.float64)
 
     # Compute the geometric mean
     if stat == "gmean":
 
         def stat_func(stack_chunk, metadata):
-            product = np.nanprod(stack_chunk, axis=2)
-            count = np.count_nonzero(np.nan_to_num(stack_chunk), axis=2)
-            gmean = np.array([p ** (1.0 / c) for p, c in zip(product, count)])
-            gmean[gmean == 1] = np.nan
+            # exp of the mean of the logarithms, in float64 to avoid the
+            # overflow/underflow of the product for long time series. A zero
+            # value gives log -inf, then the result is 0 as with the product
+            log_chunk = stack_chunk.astype(np.float64)
+            np.log(log_chunk, out=log_chunk)
+            gmean = np.exp(np.nanmean(log_chunk, axis=0))
+            # the geometric mean is not defined for negative values, the log
+            # is nan and would be ignored, so these pixels are nan
+            gmean[(stack_chunk < 0).any(axis=0)] = np.nan
             return gmean
 
     # Compute the maximum value
     if stat == "max":
 
         def stat_func(stack_chunk, metadata):
-            return np.nanmax(stack_chunk, axis=2)
+            return np.nanmax(stack_chunk, axis=0)
 
     # Compute the minimum value
     if stat == "min":
 
         def stat_func(stack_chunk, metadata):
-            return np.nanmin(stack_chunk, axis=2)
+            return np.nanmin(stack_chunk, axis=0)
 
     # Compute the standard deviation
     if stat == "std":
 
         def stat_func(stack_chunk, metadata):
-            return np.nanstd(stack_chunk, axis=2)
+            return np.nanstd(stack_chunk, axis=0, dtype=np.float64)
 
     # Compute the valid pixels
     # this count the valid data (no nans) across the z-axis
     if stat == "valid_pixels":
 
         def stat_func(stack_chunk, metadata):
-            return stack_chunk.shape[2] - np.isnan(stack_chunk).sum(axis=2)
+            return stack_chunk.shape[0] - np.isnan(stack_chunk).sum(axis=0)
 
     # Compute the percentile NN
     if stat.startswith("percentile_"):
         p = int(stat.split("_")[1])
 
         def stat_func(stack_chunk, metadata):
-            return np.nanpercentile(stack_chunk, p, axis=2)
+            return np.nanpercentile(time_last(stack_chunk), p, axis=2)
 
     # Compute the last valid pixel
     if stat == "last_pixel":
 
-        def last_pixel(pixel_time_series, index_sort):
-            if np.isnan(pixel_time_series).all():
-                return np.nan
-            for index in index_sort:
-                if not np.isnan(pixel_time_series[index]):
-                    return pixel_time_series[index]
-
         def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata["date"])[
-                ::-1
-            ]  # from the most recent to the oldest
-            return np.apply_along_axis(last_pixel, 2, stack_chunk, index_sort)
+            index, _ = last_valid_index(stack_chunk, metadata["date"])
+            # if all are nan the value in the index is nan
+            return np.take_along_axis(stack_chunk, index[np.newaxis], axis=0)[0]
 
     # Compute the julian day of the last valid pixel
     if stat == "jday_last_pixel":
 
-        def jday_last_pixel(pixel_time_series, index_sort, jdays):
-            if np.isnan(pixel_time_series).all():
-                return 0  # better np.nan but there is bug with multiprocessing with return nan value here
-            for index in index_sort:
-                if not np.isnan(pixel_time_series[index]):
-                    return jdays[index]
-
         def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata["date"])[
-                ::-1
-            ]  # from the most recent to the oldest
-            return np.apply_along_axis(
-                jday_last_pixel, 2, stack_chunk, index_sort, metadata["jday"]
-            )
+            index, any_valid = last_valid_index(stack_chunk, metadata["date"])
+            # better np.nan but there is bug with multiprocessing with return nan value here
+            return np.where(any_valid, metadata["jday"][index], 0)
 
     # Compute the julian day of the median value
     if stat == "jday_median":
 
-        def jday_median(pixel_time_series, index_sort, jdays):
-            if np.isnan(pixel_time_series).all():
-                return 0  # better np.nan but there is bug with multiprocessing with return nan value here
-            jdays = [
-                jdays[index]
-                for index in index_sort
-                if not np.isnan(pixel_time_series[index])
-            ]
-            return np.ceil(np.median(jdays))
-
         def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata["date"])  # from the oldest to most recent
-            return np.apply_along_axis(
-                jday_median, 2, stack_chunk, index_sort, metadata["jday"]
+            stack_chunk = time_last(stack_chunk)
+            jdays = np.where(np.isnan(stack_chunk), np.nan, metadata["jday"])
+            jdays = np.sort(jdays, axis=2)
+            count = (~np.isnan(stack_chunk)).sum(axis=2)
+            # better np.nan but there is bug with multiprocessing with return nan value here
+            return np.where(
+                count == 0, 0, np.ceil(percentile_from_sorted(jdays, count, 50))
             )
 
     # Compute the trimmed median with lower limit and upper limit
@@ -141,91 +191,562 @@ def statistic(stat, images, band, num_process, chunksize):
         lower = int(stat.split("_")[2])
         upper = int(stat.split("_")[3])
 
-        def trim_mean(pixel_time_series):
-            if np.isnan(pixel_time_series).all():
-                return 0  # better np.nan but there is bug with multiprocessing with return nan value here
-            pts = pixel_time_series[~np.isnan(pixel_time_series)]
-            if len(pts) <= 2:
-                return np.percentile(pts, (lower + upper) / 2)
-            return np.mean(
-                pts[
-                    (pts >= np.percentile(pts, lower))
-                    & (pts <= np.percentile(pts, upper))
-                ]
+        def stat_func(stack_chunk, metadata):
+            stack_chunk = time_last(stack_chunk)
+            stack_sorted = np.sort(stack_chunk, axis=2)
+            count = (~np.isnan(stack_chunk)).sum(axis=2)
+            lower_value, middle_value, upper_value = [
+                percentile_from_sorted(stack_sorted, count, q)[:, :, np.newaxis]
+                for q in (lower, (lower + upper) / 2, upper)
+            ]
+            # the nan values are out of the limits
+            in_limits = (stack_sorted >= lower_value) & (stack_sorted <= upper_value)
+            trim_mean = np.where(in_limits, stack_sorted, 0).sum(
+                axis=2, dtype=np.float64
+            ) / in_limits.sum(axis=2)
+            # better np.nan but there is bug with multiprocessing with return nan value here
+            return np.where(
+                count == 0,
+                0,
+                np.where(count <= 2, middle_value[:, :, 0], trim_mean),
             )
 
+    # internal statistics for the state of the incremental mode: sum, sum of
+    # squares and the day (ordinal) of the last valid pixel
+    if stat == "sum":
+
+        def stat_func(stack_chunk, metadata):
+            return np.nansum(stack_chunk, axis=0, dtype=np.float64)
+
+    if stat == "sum_squares":
+
         def stat_func(stack_chunk, metadata):
-            return np.apply_along_axis(trim_mean, 2, stack_chunk)
+            return np.nansum(np.square(stack_chunk, dtype=np.float64), axis=0)
+
+    if stat == "last_day":
+
+        def stat_func(stack_chunk, metadata):
+            index, any_valid = last_valid_index(stack_chunk, metadata["date"])
+            return np.where(any_valid, metadata["ordinal"][index], 0)
 
     # Compute the linear trend using least-squares method
     if stat == "linear_trend":
 
-        def linear_trend(pixel_time_series, index_sort, date_list):
-            if (
-                np.isnan(pixel_time_series).all()
-                or len(pixel_time_series[~np.isnan(pixel_time_series)]) == 1
-            ):
-                return np.nan
-            # Unix timestamp in days
-            x = [
-                int(int(date_list[index].strftime("%s")) / 86400)
-                for index in index_sort
-            ]
-            x = [i - x[0] for i in x]  # diff from minimum
-            pts = np.array([pixel_time_series[index] for index in index_sort])
-            y = np.ma.array(pts, mask=np.isnan(pts))
-
-            ssxm, ssxym, ssyxm, ssym = np.ma.cov(x, y, bias=1).flat
-            slope = ssxym / ssxm
+        def stat_func(stack_chunk, metadata):
+            # least-squares slope over the valid pixels of each time series:
+            # sum((x - x_mean) * (y - y_mean)) / sum((x - x_mean) ** 2)
+            # the sums are accumulated layer by layer in float64, so the
+            # temporaries are only of one layer
+            days = metadata["day"].astype(np.float64)
+            count = np.zeros(stack_chunk.shape[1:], dtype=np.intp)
+            x_sum = np.zeros(stack_chunk.shape[1:])
+            y_sum = np.zeros(stack_chunk.shape[1:])
+            for day, layer in zip(days, stack_chunk):
+                valid = ~np.isnan(layer)
+                count += valid
+                x_sum += valid * day
+                y_sum += np.where(valid, layer, 0)
+            x_mean = x_sum / count
+            y_mean = y_sum / count
+            xy_dev = np.zeros(stack_chunk.shape[1:])
+            xx_dev = np.zeros(stack_chunk.shape[1:])
+            for day, layer in zip(days, stack_chunk):
+                valid = ~np.isnan(layer)
+                x_dev = np.where(valid, day - x_mean, 0)
+                xy_dev += np.where(valid, x_dev * (layer - y_mean), 0)
+                xx_dev += x_dev**2
+            slope = xy_dev / xx_dev
+            slope[count < 2] = np.nan
             return slope * 1000000
 
-        def stat_func(stack_chunk, metadata):
-            index_sort = np.argsort(metadata["date"])  # from the oldest to most recent
-            return np.apply_along_axis(
-                linear_trend, 2, stack_chunk, index_sort, metadata["date"]
+    return stat_func
+
+
+def is_masked_stat(stat):
+    """
+    Return if the statistic can be computed in the masked integer path.
+    """
+    return stat in MASKED_STATS or stat.startswith("percentile_")
+
+
+def sort_masked(stack_chunk, valid):
+    """
+    Sort along the time the integer stack chunk (t, y, x) with the invalid
+    values at the end, return the sorted stack (y, x, t) and the count of
+    valid values per pixel.
+    """
+    stack_sorted = time_last(stack_chunk)
+    # the invalid values are set to the maximum of the type, so they are
+    # sorted after all valid values
+    np.copyto(
+        stack_sorted,
+        np.iinfo(stack_chunk.dtype).max,
+        where=~np.moveaxis(valid, 0, -1),
+    )
+    stack_sorted.sort(axis=2)
+    return stack_sorted, valid.sum(axis=0)
+
+
+def get_masked_stat_func(stat):
+    """
+    Return the function that compute the statistic for an integer stack
+    chunk (t, y, x) and its validity mask, the pixels without valid values
+    are nan as in get_stat_func.
+    """
+    # Compute the median
+    if stat == "median":
+
+        def stat_func(stack_chunk, valid, metadata):
+            stack_sorted, count = sort_masked(stack_chunk, valid)
+            median = percentile_from_sorted(stack_sorted, count, 50)
+            median[count == 0] = np.nan
+            return median
+
+    # Compute the maximum value
+    if stat == "max":
+
+        def stat_func(stack_chunk, valid, metadata):
+            initial = np.iinfo(stack_chunk.dtype).min
+            max_value = np.max(stack_chunk, axis=0, where=valid, initial=initial)
+            return np.where(valid.any(axis=0), max_value, np.nan)
+
+    # Compute the minimum value
+    if stat == "min":
+
+        def stat_func(stack_chunk, valid, metadata):
+            initial = np.iinfo(stack_chunk.dtype).max
+            min_value = np.min(stack_chunk, axis=0, where=valid, initial=initial)
+            return np.where(valid.any(axis=0), min_value, np.nan)
+
+    # Compute the valid pixels
+    if stat == "valid_pixels":
+
+        def stat_func(stack_chunk, valid, metadata):
+            return valid.sum(axis=0)
+
+    # Compute the percentile NN
+    if stat.startswith("percentile_"):
+        p = int(stat.split("_")[1])
+
+        def stat_func(stack_chunk, valid, metadata):
+            stack_sorted, count = sort_masked(stack_chunk, valid)
+            percentile = percentile_from_sorted(stack_sorted, count, p)
+            percentile[count == 0] = np.nan
+            return percentile
+
+    return stat_func
+
+
+def is_quantile_stat(stat):
+    """
+    Return if the statistic can be approximated from the histogram.
+    """
+    return stat == "median" or stat.startswith("percentile_")
+
+
+def read_layer(layer, bands, xc, xc_size, yc, yc_size, out, valid=None):
+    """
+    Read the chunk of a layer, the images of the same date (chips) mosaicked
+    in out (bands, y, x), initialized as in get_chunk. The first valid value
+    of the images in the layer order is kept for each pixel. Return True if
+    any image of the layer overlaps the chunk.
+    """
+    in_layer = False
+    scratch = scratch_valid = None
+    for image in layer:
+        if not in_layer:
+            # the first image is read directly in the layer
+            in_layer = (
+                image.get_chunk_in_wrapper(
+                    bands, xc, xc_size, yc, yc_size, out=out, valid=valid
+                )
+                is not None
             )
+            continue
+        if scratch is None:
+            scratch = np.empty_like(out)
+            scratch_valid = None if valid is None else np.empty_like(valid)
+        if valid is None:
+            scratch.fill(np.nan)
+        else:
+            scratch.fill(0)
+            scratch_valid.fill(False)
+        if (
+            image.get_chunk_in_wrapper(
+                bands, xc, xc_size, yc, yc_size, out=scratch, valid=scratch_valid
+            )
+            is None
+        ):
+            continue
+        # fill only the pixels without a valid value yet
+        if valid is None:
+            np.copyto(out, scratch, where=np.isnan(out))
+        else:
+            np.copyto(out, scratch, where=~valid & scratch_valid)
+            valid |= scratch_valid
+    return in_layer
+
+
+def histogram_quantiles(
+    layers, bands, xc, xc_size, yc, yc_size, stats, quantile_bins, quantile_range
+):
+    """
+    Approximate median and percentiles of the chunk from a histogram of
+    quantile_bins bins of equal width over quantile_range (min, max) for
+    each pixel, the values out of the range are counted in the first or
+    last bin. The images are read one by one, so the memory does not depend
+    on the number of images. The quantile is interpolated between the
+    centers of the bins as np.nanpercentile does between the values, the
+    error is at most half of the bin width for values in the range. The
+    layers are lists of images mosaicked as in read_layer.
+
+    Return the array (len(bands) * len(stats), y, x) or None if no image
+    overlaps the chunk.
+    """
+    range_min, range_max = quantile_range
+    bin_width = (range_max - range_min) / quantile_bins
+    bin_centers = range_min + (np.arange(quantile_bins) + 0.5) * bin_width
+
+    # histogram of each band as a flat array (bins * pixels) for update all
+    # pixels of a layer at once, each pixel is counted once by layer
+    n_pixels = yc_size * xc_size
+    pixels = np.arange(n_pixels)
+    histogram = np.zeros(
+        (len(bands), quantile_bins * n_pixels),
+        dtype=np.min_scalar_type(len(layers)),
+    )
+    chunk = np.empty((len(bands), yc_size, xc_size), dtype=np.float32)
+    in_chunk = False
+    for layer in layers:
+        chunk.fill(np.nan)
+        if not read_layer(layer, bands, xc, xc_size, yc, yc_size, out=chunk):
+            continue
+        in_chunk = True
+        for band_idx in range(len(bands)):
+            values = chunk[band_idx].ravel()
+            valid = ~np.isnan(values)
+            bins = np.clip(
+                ((values[valid] - range_min) / bin_width).astype(np.intp),
+                0,
+                quantile_bins - 1,
+            )
+            histogram[band_idx, bins * n_pixels + pixels[valid]] += 1
+    if not in_chunk:
+        return None
+
+    result = []
+    for band_idx in range(len(bands)):
+        cumulative = np.cumsum(
+            histogram[band_idx].reshape(quantile_bins, yc_size, xc_size),
+            axis=0,
+            dtype=np.uint32,
+        )
+        count = cumulative[-1]
+        for stat in stats:
+            q = 50 if stat == "median" else int(stat.split("_")[1])
+            # positions of the values to interpolate as in percentile_from_sorted
+            position = (count - 1) * (q / 100.0)
+            index_low = np.maximum(np.floor(position), 0)
+            index_high = np.minimum(index_low + 1, np.maximum(count - 1, 0))
+            # the bin of the value in the position i is the number of bins with
+            # less or equal than i values before it
+            value_low, value_high = [
+                bin_centers[
+                    np.minimum((cumulative <= index).sum(axis=0), quantile_bins - 1)
+                ]
+                for index in (index_low, index_high)
+            ]
+            quantile = value_low + (value_high - value_low) * (position - index_low)
+            quantile[count == 0] = np.nan
+            result.append(quantile)
+    return np.array(result, dtype=float)
+
+
+def images_by_chunk(images, y_chunks, x_chunks):
+    """
+    Spatial index of the images footprints over the chunks grid of the
+    wrapper, return a dict with the chunk location (i, j) as key and the
+    indexes of the images that overlap that chunk as value.
+    """
+    y_bounds = np.cumsum((0,) + tuple(y_chunks))
+    x_bounds = np.cumsum((0,) + tuple(x_chunks))
+
+    index = {(i, j): [] for i in range(len(y_chunks)) for j in range(len(x_chunks))}
+    for image_idx, image in enumerate(images):
+        # first and last (exclusive) chunks touched by the image bounds
+        i_min = np.searchsorted(y_bounds, image.yi_min, side="right") - 1
+        i_max = np.searchsorted(y_bounds, image.yi_max, side="left")
+        j_min = np.searchsorted(x_bounds, image.xi_min, side="right") - 1
+        j_max = np.searchsorted(x_bounds, image.xi_max, side="left")
+        for i in range(max(i_min, 0), min(i_max, len(y_chunks))):
+            for j in range(max(j_min, 0), min(j_max, len(x_chunks))):
+                index[(i, j)].append(image_idx)
+    return index
+
+
+def statistic(
+    stats,
+    images,
+    bands,
+    num_process,
+    chunksize,
+    on_block=None,
+    scheduler="processes",
+    cache_dir=None,
+    quantile_bins=None,
+    quantile_range=None,
+    group_dates=False,
+):
+    """
+    Compute the statistics for the bands over the wrapper extent.
+
+    All the bands of each image chunk are read at once and all the
+    statistics are computed from the same stack chunk. The result has the
+    shape (len(bands) * len(stats), y, x), the statistics of the first band
+    then the ones of the second band and so on.
+
+    If on_block is None the whole result array is returned, else the result
+    is not materialised and on_block(block_array, yc, xc) is called for each
+    chunk as soon as it is computed, with the position of the chunk in the
+    wrapper. The scheduler is one of SCHEDULERS. The chunksize is the size of
+    square chunks or the chunks grid ((y chunks), (x chunks)) of the wrapper.
+
+    If cache_dir is set, the result of each chunk is saved in that directory
+    and reused in the next runs while the statistics, bands, no data values
+    and the images that overlap the chunk (path, modification time and size)
+    are the same.
+
+    If quantile_bins is set, the median and percentiles are approximated with
+    a histogram for each pixel over quantile_range (see histogram_quantiles)
+    instead of the stack of all images.
+
+    If group_dates is set, the images of the same date (the chips of a
+    date) are mosaicked in one layer of the stack (see read_layer), so the
+    depth of the stack is the number of dates; the images require the date
+    from the filename.
+    """
+    # create a empty initial wrapper raster for managed dask parallel
+    # in chunks and storage result
+    wrapper_array = da.empty(Image.wrapper_shape, chunks=chunksize)
+
+    # masked integer path: if all the statistics support it and all images
+    # are integers, the stack keeps the native type with a validity mask
+    # instead of float32 with nan
+    integer_type = None
+    if all(is_masked_stat(stat) for stat in stats) and all(
+        image.integer_type is not None for image in images
+    ):
+        integer_type = np.result_type(*[image.integer_type for image in images])
+        stat_funcs = [get_masked_stat_func(stat) for stat in stats]
+    else:
+        stat_funcs = [get_stat_func(stat) for stat in stats]
+
+    # layers of the stack: the images of each date in the order of the
+    # first image of the date, or each image in its own layer
+    if group_dates:
+        dates = list(dict.fromkeys(image.date for image in images))
+        image_layer = [dates.index(image.date) for image in images]
+    else:
+        image_layer = list(range(len(images)))
+    layers = [[] for _ in range(max(image_layer) + 1)]
+    for image, layer_idx in zip(images, image_layer):
+        layers[layer_idx].append(image)
+
+    # for some statistics that required filename as metadata, computed once
+    # for all chunks, the images of a layer have the same date
+    layers_metadata = {}
+    if set(stats) & {"last_pixel", "jday_last_pixel", "jday_median", "last_day"}:
+        layers_metadata["date"] = np.array([layer[0].date for layer in layers])
+    if "last_day" in stats:
+        layers_metadata["ordinal"] = np.array(
+            [layer[0].date.toordinal() for layer in layers]
+        )
+    if set(stats) & {"jday_last_pixel", "jday_median"}:
+        layers_metadata["jday"] = np.array([layer[0].jday for layer in layers])
+    if "linear_trend" in stats:
+        # days from the oldest image
+        days = np.array([layer[0].date.toordinal() for layer in layers])
+        layers_metadata["day"] = days - days.min()
+
+    # only the images that overlap a chunk are read for it, in the layers
+    # they belong to
+    chunk_images = images_by_chunk(images, *wrapper_array.chunks)
+    chunk_layers = {
+        location: sorted({image_layer[idx] for idx in images_idx})
+        for location, images_idx in chunk_images.items()
+    }
+
+    # key in the cache of the result of each chunk
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        fingerprints = [image_fingerprint(image) for image in images]
+        y_offsets = np.cumsum((0,) + wrapper_array.chunks[0][:-1])
+        x_offsets = np.cumsum((0,) + wrapper_array.chunks[1][:-1])
+        chunk_keys = {}
+        for (i, j), images_idx in chunk_images.items():
+            window = (
+                y_offsets[i],
+                x_offsets[j],
+                wrapper_array.chunks[0][i],
+                wrapper_array.chunks[1][j],
+            )
+            chunk_keys[(i, j)] = chunk_key(
+                stats,
+                bands,
+                window,
+                [fingerprints[idx] for idx in images_idx],
+                options=[quantile_bins, quantile_range, group_dates],
+            )
+        chunks_cached = sum(
+            os.path.isfile(chunk_path(cache_dir, key)) for key in chunk_keys.values()
+        )
+        print("  chunks in cache: {}/{}".format(chunks_cached, len(chunk_keys)))
+
+    # global properties of the images for the worker processes
+    images_properties = Image.get_global_properties()
 
     # Compute the statistical for the respective chunk
-    def calc(block, block_id=None, chunksize=None):
-        yc = block_id[0] * chunksize
-        yc_size = block.shape[0]
-        xc = block_id[1] * chunksize
-        xc_size = block.shape[1]
-
-        # make stack reading all images only in specific chunk
-        chunks_list = [
-            image.get_chunk_in_wrapper(band, xc, xc_size, yc, yc_size)
-            for image in images
-        ]
-        # delete empty chunks
-        mask_none = [False if x is None else True for x in chunks_list]
-        chunks_list = np.array([i for i in chunks_list if i is not None])
+    def calc(block, block_info=None):
+        Image.set_global_properties(images_properties)
+        if cache_dir is None:
+            return calc_chunk(block_info)
+        key = chunk_keys[block_info[0]["chunk-location"]]
+        chunk_array = load_chunk(cache_dir, key)
+        if chunk_array is None:
+            chunk_array = calc_chunk(block_info)
+            save_chunk(cache_dir, key, chunk_array)
+        return chunk_array
+
+    def calc_chunk(block_info):
+        # position of the chunk in the wrapper
+        (yc, yc_max), (xc, xc_max) = block_info[0]["array-location"]
+        yc_size = yc_max - yc
+        xc_size = xc_max - xc
+        layers_idx = np.array(chunk_layers[block_info[0]["chunk-location"]], dtype=int)
+
+        if quantile_bins is not None:
+            result = histogram_quantiles(
+                [layers[idx] for idx in layers_idx],
+                bands,
+                xc,
+                xc_size,
+                yc,
+                yc_size,
+                stats,
+                quantile_bins,
+                quantile_range,
+            )
+            if result is None:
+                # all chunks are empty, return the chunk with nan
+                return np.full((len(bands) * len(stats), yc_size, xc_size), np.nan)
+            return result
+
+        # time-major stack of the chunk (bands, layers, y, x) allocated once,
+        # each layer is read directly in its contiguous slice
+        stack_shape = (len(bands), len(layers_idx), yc_size, xc_size)
+        if integer_type is None:
+            stack = np.full(stack_shape, np.nan, dtype=np.float32)
+            valid = None
+        else:
+            stack = np.zeros(stack_shape, dtype=integer_type)
+            valid = np.zeros(stack_shape, dtype=bool)
+
+        # make stack reading all layers only in specific chunk
+        def read_chunk(stack_idx):
+            out_valid = None if valid is None else valid[:, stack_idx]
+            return read_layer(
+                layers[layers_idx[stack_idx]],
+                bands,
+                xc,
+                xc_size,
+                yc,
+                yc_size,
+                out=stack[:, stack_idx],
+                valid=out_valid,
+            )
 
-        if not chunks_list.size:
+        if scheduler == "hybrid":
+            in_chunk = list(get_reader_pool().map(read_chunk, range(len(layers_idx))))
+        else:
+            in_chunk = [read_chunk(stack_idx) for stack_idx in range(len(layers_idx))]
+
+        if not any(in_chunk):
             # all chunks are empty, return the chunk with nan
-            return np.full((yc_size, xc_size), np.nan)
+            return np.full((len(bands) * len(stats), yc_size, xc_size), np.nan)
+        if not all(in_chunk):
+            # delete empty chunks
+            stack = stack[:, in_chunk]
+            valid = None if valid is None else valid[:, in_chunk]
+            layers_idx = layers_idx[in_chunk]
 
         # for some statistics that required filename as metadata
-        metadata = {}
-        if stat in ["last_pixel", "jday_last_pixel", "jday_median", "linear_trend"]:
-            metadata["date"] = np.array([image.date for image in images])[mask_none]
-        if stat in ["jday_last_pixel", "jday_median"]:
-            metadata["jday"] = np.array([image.jday for image in images])[mask_none]
-
-        stack_chunk = np.stack(chunks_list, axis=2)
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            return stat_func(stack_chunk, metadata)
+        metadata = {key: values[layers_idx] for key, values in layers_metadata.items()}
+
+        result = []
+        for band_idx in range(len(bands)):
+            stack_chunk = stack[band_idx]
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                if valid is None:
+                    result += [
+                        stat_func(stack_chunk, metadata) for stat_func in stat_funcs
+                    ]
+                else:
+                    result += [
+                        stat_func(stack_chunk, valid[band_idx], metadata)
+                        for stat_func in stat_funcs
+                    ]
+        return np.array(result, dtype=float)
 
     # process
     map_blocks = da.map_blocks(
         calc,
         wrapper_array,
-        chunks=wrapper_array.chunks,
-        chunksize=chunksize,
+        new_axis=0,
+        chunks=((len(bands) * len(stats),),) + wrapper_array.chunks,
         dtype=float,
     )
-    result_array = map_blocks.compute(num_workers=num_process, scheduler="processes")
-
-    return result_array
+    if scheduler == "threads":
+        pool = ThreadPoolExecutor(num_process)
+        dask_scheduler = "threads"
+    else:
+        pool = ProcessPoolExecutor(num_process, mp_context=get_context("spawn"))
+        dask_scheduler = "processes"
+
+    # keep the same workers (and their opened datasets) for all chunks
+    with pool:
+        if on_block is None:
+            result_array = map_blocks.compute(
+                scheduler=dask_scheduler, num_workers=num_process, pool=pool
+            )
+            # release the datasets opened in this process
+            dataset_pool.clear()
+            return result_array
+
+        # stream the result by batches of chunks, in row order, so that only
+        # the chunks of the current batch are in memory at the same time
+        y_offsets = np.cumsum((0,) + map_blocks.chunks[1][:-1])
+        x_offsets = np.cumsum((0,) + map_blocks.chunks[2][:-1])
+        blocks = [
+            (block, y_offsets[i], x_offsets[j])
+            for (_, i, j), block in np.ndenumerate(map_blocks.to_delayed())
+        ]
+        batch_size = (num_process or 1) * 4
+        for idx in range(0, len(blocks), batch_size):
+            batch = blocks[idx : idx + batch_size]
+            results = dask.compute(
+                *[block for block, _, _ in batch],
+                scheduler=dask_scheduler,
+                num_workers=num_process,
+                pool=pool,
+            )
+            for block_array, (_, yc, xc) in zip(results, batch):
+                on_block(block_array, int(yc), int(xc))
+            print(
+                "\r  chunks processed: {}/{}".format(idx + len(batch), len(blocks)),
+                flush=True,
+                end="",
+            )
+    print()
+    dataset_pool.clear()
@@ -0,0 +1,96 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# the closing module imports GDAL and scipy
+pytest.importorskip("osgeo")
+pytest.importorskip("scipy")
+
+# the filter is in the component package at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+
+from component.workers.closing import (  # noqa: E402
+    filter_closing,
+    filter_closing_window,
+)
+
+
+def otb_closing(array):
+    """
+    Reference of otbcli_GrayScaleMorphologicalOperation -filter closing with
+    a ball of radius 1 (the full 3x3 neighbourhood) and the pixels outside
+    the image ignored, followed by the fill of the 0 pixels B*(A==0)+A in
+    UInt16.
+    """
+    rows, cols = array.shape
+
+    def neighbourhood(image, y, x):
+        return image[max(y - 1, 0) : y + 2, max(x - 1, 0) : x + 2]
+
+    dilated = np.empty_like(array)
+    for y in range(rows):
+        for x in range(cols):
+            dilated[y, x] = neighbourhood(array, y, x).max()
+    closed = np.empty_like(array)
+    for y in range(rows):
+        for x in range(cols):
+            closed[y, x] = neighbourhood(dilated, y, x).min()
+
+    filled = array.astype(np.uint16)
+    filled[array == 0] = closed[array == 0]
+    return filled
+
+
+class ArrayBand:
+    """
+    Band of a raster read from an array, as the GDAL band read by
+    filter_closing_window.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.YSize, self.XSize = array.shape
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        return self.array[yoff : yoff + ysize, xoff : xoff + xsize].copy()
+
+
+def make_raster(shape, dtype=np.uint16, seed=0):
+    rng = np.random.default_rng(seed)
+    array = rng.integers(1, np.iinfo(dtype).max, shape).astype(dtype)
+    array[rng.random(shape) < 0.5] = 0
+    return array
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+@pytest.mark.parametrize("shape", [(1, 1), (1, 6), (7, 1), (9, 13), (24, 17)])
+def test_filter_closing_otb(shape, dtype):
+    array = make_raster(shape, dtype)
+
+    result = filter_closing(array)
+
+    assert result.dtype == np.uint16
+    np.testing.assert_array_equal(result, otb_closing(array))
+    # only the 0 pixels are filled
+    np.testing.assert_array_equal(result[array != 0], array[array != 0])
+
+
+@pytest.mark.parametrize("window_size", [1, 2, 3, 5, 16, 64, 500])
+@pytest.mark.parametrize("shape", [(1, 1), (5, 3), (37, 50), (64, 64), (130, 77)])
+def test_filter_closing_window(shape, window_size):
+    array = make_raster(shape)
+    band = ArrayBand(array)
+
+    # the windows as in write_closing
+    result = np.zeros(shape, dtype=np.uint16)
+    for yoff in range(0, shape[0], window_size):
+        ysize = min(window_size, shape[0] - yoff)
+        for xoff in range(0, shape[1], window_size):
+            xsize = min(window_size, shape[1] - xoff)
+            result[yoff : yoff + ysize, xoff : xoff + xsize] = filter_closing_window(
+                band, xoff, yoff, xsize, ysize
+            )
+
+    np.testing.assert_array_equal(result, filter_closing(array))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2016-2018 Xavier Corredor Llano, SMBYC
+#  Email: xcorredorl at ideam.gov.co
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+import datetime
+
+import numpy as np
+import pytest
+
+# stats imports the image module that requires GDAL
+pytest.importorskip("osgeo")
+
+from stack_composed.stats import get_stat_func, histogram_quantiles  # noqa: E402
+
+
+# the previous per-pixel functions, applied along the time axis
+def last_pixel(pixel_time_series, index_sort):
+    if np.isnan(pixel_time_series).all():
+        return np.nan
+    for index in index_sort:
+        if not np.isnan(pixel_time_series[index]):
+            return pixel_time_series[index]
+
+
+def jday_last_pixel(pixel_time_series, index_sort, jdays):
+    if np.isnan(pixel_time_series).all():
+        return 0
+    for index in index_sort:
+        if not np.isnan(pixel_time_series[index]):
+            return jdays[index]
+
+
+def make_stack(n_images, repeated_dates=False, seed=0):
+    """
+    Time-major stack (images, y, x) with nan values, all-nan pixels and the
+    metadata of the images with random (optionally repeated) dates.
+    """
+    rng = np.random.default_rng(seed)
+    stack = rng.random((n_images, 12, 15)).astype(np.float32)
+    stack[rng.random(stack.shape) < 0.6] = np.nan
+    stack[:, 0, :] = np.nan
+    stack[:, 5, 7] = np.nan
+    days = rng.integers(0, 40 if repeated_dates else 3000, n_images)
+    dates = np.array(
+        [datetime.date(2018, 1, 1) + datetime.timedelta(int(day)) for day in days]
+    )
+    jdays = np.array([date.timetuple().tm_yday for date in dates])
+    return stack, {"date": dates, "jday": jdays}
+
+
+@pytest.mark.parametrize("repeated_dates", [False, True])
+@pytest.mark.parametrize("n_images", [1, 7, 60])
+def test_last_pixel(n_images, repeated_dates):
+    stack, metadata = make_stack(n_images, repeated_dates)
+    index_sort = np.argsort(metadata["date"])[::-1]
+    expected = np.apply_along_axis(last_pixel, 0, stack, index_sort)
+
+    result = get_stat_func("last_pixel")(stack, metadata)
+
+    np.testing.assert_array_equal(result, expected)
+    assert np.isnan(result[0]).all()
+
+
+@pytest.mark.parametrize("repeated_dates", [False, True])
+@pytest.mark.parametrize("n_images", [1, 7, 60])
+def test_jday_last_pixel(n_images, repeated_dates):
+    stack, metadata = make_stack(n_images, repeated_dates)
+    index_sort = np.argsort(metadata["date"])[::-1]
+    expected = np.apply_along_axis(
+        jday_last_pixel, 0, stack, index_sort, metadata["jday"]
+    )
+
+    result = get_stat_func("jday_last_pixel")(stack, metadata)
+
+    np.testing.assert_array_equal(result, expected)
+    assert (result[0] == 0).all()
+
+
+# as in statistic, the warnings of log(0), log(-1) and all nan are ignored
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_gmean_negative_values():
+    stack = np.full((4, 2, 3), np.nan, dtype=np.float32)
+    stack[:, 0, 0] = [1, 4, np.nan, 16]
+    stack[:, 0, 1] = [-1, 4, 2, 8]
+    stack[:, 0, 2] = [0, 4, 2, np.nan]
+    stack[:, 1, 0] = [np.nan, -3, np.nan, np.nan]
+
+    result = get_stat_func("gmean")(stack, {})
+
+    np.testing.assert_allclose(result[0, 0], 4)
+    # any negative value gives nan, as the product with a fractional root
+    assert np.isnan(result[0, 1]) and np.isnan(result[1, 0])
+    assert result[0, 2] == 0
+    # all nan
+    assert np.isnan(result[1, 1])
+
+
+class ArrayImage:
+    """
+    Image of the whole wrapper read from an array (bands, y, x) with nan as
+    no data, as the layers read by histogram_quantiles.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def get_chunk_in_wrapper(
+        self, bands, xc, xc_size, yc, yc_size, out=None, valid=None
+    ):
+        out[:] = self.array[
+            [band - 1 for band in bands], yc : yc + yc_size, xc : xc + xc_size
+        ]
+        return out
+
+
+# the warnings of np.nanpercentile for the all nan pixels
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize(
+    "quantile_bins, quantile_range, integer",
+    [(300, (-0.5, 299.5), True), (37, (-10, 600), True), (50, (0, 1), False)],
+)
+def test_histogram_quantiles(quantile_bins, quantile_range, integer):
+    rng = np.random.default_rng(1)
+    stack = rng.uniform(*quantile_range, (25, 2, 9, 11))
+    if integer:
+        stack = np.clip(np.round(stack), 0, None)
+    stack = stack.astype(np.float32)
+    stack[rng.random(stack.shape) < 0.4] = np.nan
+    stack[:, :, 0, :] = np.nan
+    stats = ["median", "percentile_10", "percentile_25", "percentile_90"]
+    layers = [[ArrayImage(layer)] for layer in stack]
+
+    result = histogram_quantiles(
+        layers, [1, 2], 1, 10, 0, 9, stats, quantile_bins, quantile_range
+    )
+
+    bin_width = (quantile_range[1] - quantile_range[0]) / quantile_bins
+    window = stack[:, :, :, 1:]
+    expected = [
+        np.nanpercentile(window[:, band_idx], q, axis=0)
+        for band_idx in range(2)
+        for q in (50, 10, 25, 90)
+    ]
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    error = np.abs(result - expected)[~np.isnan(result)]
+    assert error.max() <= bin_width / 2 + 1e-6